@@ -0,0 +1,178 @@
+from typing import *
+
+import numpy as np
+import pandas as pd
+from scipy.stats import f_oneway, kurtosis, skew
+
+from constraints import *
+from dataset import *
+
+"""
+
+This module collects the orientation analysis shared by the
+`03_OSI-Static_Classifier`, `03_OSI-Drifting_Classifier` and
+`04_Cross_Condition_Analysis` notebooks:
+
+  get_orientation_spike_statistics  →  get_tuning_curves
+    →  get_selectivity_indices, get_anova_p_values
+    →  select_tuned_units  →  decode_orientation
+    →  compare_conditions
+
+Each step only takes the outputs of the previous ones, so that the
+chain can be run stage by stage by `pipeline.py`.
+
+"""
+
+def get_orientation_spike_statistics(stimulus_name: str,
+                                     session: Session = CURRENT_SESSION,
+                                     **kwargs) -> pd.DataFrame:
+  """Return the conditionwise spike statistics of `stimulus_name` with orientations.
+
+  The table is indexed by `stimulus_condition_id`, with a `unit_id`
+  and an `orientation` column added to the
+  `get_conditionwise_spike_statistics` columns.  Conditions with a
+  'null' orientation are dropped.
+
+  All filters which `get_units` and `get_stimulus_presentations`
+  accept are meaningful.
+
+  """
+  spike_data = get_conditionwise_spike_statistics(stimulus_name=stimulus_name, session=session, **kwargs) \
+    .reset_index('unit_id')
+  presentations = get_stimulus_presentations(stimulus_name=stimulus_name, session=session)
+  orientation_map = presentations.reset_index().set_index('stimulus_condition_id')['orientation'].to_dict()
+  spike_data['orientation'] = spike_data.index.get_level_values('stimulus_condition_id').map(orientation_map)
+  spike_data['orientation'] = spike_data['orientation'].replace('null', np.nan)
+  spike_data = spike_data.dropna(subset=['orientation'])
+  spike_data['orientation'] = spike_data['orientation'].astype(float)
+  return spike_data
+
+def get_tuning_curves(spike_data: pd.DataFrame, value_col: str = 'spike_count') -> pd.DataFrame:
+  """Return the unit × orientation table of the mean `value_col` of `spike_data`."""
+  return spike_data.groupby(['unit_id', 'orientation'])[value_col].mean().unstack()
+
+def get_selectivity_indices(tuning_curves: pd.DataFrame, period: float = 180.0) -> pd.DataFrame:
+  """Return the preferred orientation, OSI and DSI of each unit of `tuning_curves`.
+
+  `period` is the period of the orientations: 180 for static gratings
+  and 360 for drifting gratings.  The OSI compares the response at the
+  preferred orientation with the orthogonal one, and the DSI with the
+  opposite one; the DSI is NaN when the opposite orientation was not
+  presented.
+
+  """
+  orientations = tuning_curves.columns.to_numpy(dtype=float)
+  responses = tuning_curves.to_numpy(dtype=float)
+  pref = np.nanargmax(responses, axis=1)
+  preferred_orientation = orientations[pref]
+  r_pref = responses[np.arange(len(responses)), pref]
+
+  def response_at(offset):
+    target = (preferred_orientation + offset) % period
+    match = np.isclose(orientations[None, :], target[:, None])
+    r = np.where(match, responses, 0.0).sum(axis=1)
+    return np.where(match.any(axis=1), r, np.nan)
+
+  r_orth = response_at(90.0)
+  r_opp = response_at(180.0) if period > 180.0 else np.full(len(responses), np.nan)
+  return pd.DataFrame({
+    'preferred_orientation': preferred_orientation,
+    'osi': (r_pref - r_orth) / (r_pref + r_orth + 1e-6),
+    'dsi': (r_pref - r_opp) / (r_pref + r_opp + 1e-6),
+  }, index=tuning_curves.index)
+
+def get_anova_p_values(spike_data: pd.DataFrame, value_col: str = 'spike_count') -> pd.Series:
+  """Return the one-way ANOVA p-value of `value_col` across orientations for each unit."""
+  return spike_data.groupby('unit_id').apply(
+    lambda x: f_oneway(*[group[value_col] for _, group in x.groupby('orientation')])[1]
+  ).rename('p_value')
+
+def select_tuned_units(selectivity: pd.DataFrame,
+                       p_values: pd.Series,
+                       index: str = 'osi',
+                       threshold: float = 0.5,
+                       alpha: float = 0.05) -> pd.Index:
+  """Return the ids of the units whose `index` exceeds `threshold` with p-value below `alpha`."""
+  mask = (selectivity[index] > threshold) & (p_values.reindex(selectivity.index) < alpha)
+  return selectivity.index[mask]
+
+def decode_orientation(spike_data: pd.DataFrame,
+                       unit_ids: Collection[int],
+                       value_col: str = 'spike_count',
+                       test_size: float = 0.3,
+                       random_state: int = 42) -> dict[str, float]:
+  """Return the test accuracy of orientation classifiers on the `unit_ids` responses.
+
+  The features are the `value_col` of each unit, with one sample per
+  stimulus condition, split into stratified train and test sets and
+  standardized.  The accuracy of a random forest, a linear SVM and a
+  multinomial logistic regression are returned.
+
+  """
+  from sklearn.ensemble import RandomForestClassifier
+  from sklearn.linear_model import LogisticRegression
+  from sklearn.metrics import accuracy_score
+  from sklearn.model_selection import train_test_split
+  from sklearn.preprocessing import StandardScaler
+  from sklearn.svm import SVC
+
+  selected_data = spike_data[spike_data['unit_id'].isin(unit_ids)]
+  X = selected_data.pivot_table(index='stimulus_condition_id', columns='unit_id',
+                                values=value_col, fill_value=0)
+  y = selected_data.groupby('stimulus_condition_id')['orientation'].first().loc[X.index]
+
+  X_train, X_test, y_train, y_test = train_test_split(
+    X, y, test_size=test_size, random_state=random_state, stratify=y
+  )
+  scaler = StandardScaler()
+  X_train = scaler.fit_transform(X_train)
+  X_test = scaler.transform(X_test)
+
+  models = {
+    'random_forest': RandomForestClassifier(n_estimators=100, random_state=random_state),
+    'svm': SVC(kernel='linear', C=1),
+    'logistic_regression': LogisticRegression(solver='lbfgs', max_iter=1000),
+  }
+  return {name: accuracy_score(y_test, model.fit(X_train, y_train).predict(X_test))
+          for name, model in models.items()}
+
+def compare_conditions(selectivity: Mapping[str, pd.DataFrame],
+                       selected: Mapping[str, pd.Index],
+                       session: Session = CURRENT_SESSION) -> dict[str, Any]:
+  """Return the cross-condition comparison of the tuned units.
+
+  `selectivity` and `selected` map each condition (e.g. stimulus name)
+  to the output of `get_selectivity_indices` and `select_tuned_units`
+  respectively.  The result holds:
+  - osi_shape              (condition × skewness/kurtosis of the OSI)
+  - region_counts          (region × condition number of tuned units)
+  - overlapping_units      (ids of the units tuned in every condition)
+  - overlap_osi            (unit × condition OSI of the overlapping units)
+  - overlap_preferred      (unit × condition preferred orientation of the overlapping units)
+
+  """
+  regions = get_units(session=session)['ecephys_structure_acronym']
+  osi_shape = pd.DataFrame({
+    condition: {'skewness': skew(df['osi']), 'kurtosis': kurtosis(df['osi'])}
+    for condition, df in selectivity.items()
+  }).T
+  region_counts = pd.DataFrame({
+    condition: regions.reindex(unit_ids).value_counts().sort_index()
+    for condition, unit_ids in selected.items()
+  }).fillna(0).astype(int)
+
+  overlapping_units = None
+  for unit_ids in selected.values():
+    overlapping_units = unit_ids if overlapping_units is None else overlapping_units.intersection(unit_ids)
+  if overlapping_units is None:
+    overlapping_units = pd.Index([], name='unit_id')
+
+  return {
+    'osi_shape': osi_shape,
+    'region_counts': region_counts,
+    'overlapping_units': overlapping_units,
+    'overlap_osi': pd.DataFrame({condition: df['osi'].reindex(overlapping_units)
+                                 for condition, df in selectivity.items()}),
+    'overlap_preferred': pd.DataFrame({condition: df['preferred_orientation'].reindex(overlapping_units)
+                                       for condition, df in selectivity.items()}),
+  }
@@ -154,11 +154,13 @@ class _TRUE(Constraint):
   def __init__(self): return
   def __contains__(self, obj): return True
   def mask(self, df): return pd.Series(True, index=df.index)
+  def __repr__(self): return 'TRUE'
 
 class _FALSE(Constraint):
   def __init__(self): return
   def __contains__(self, obj): return False
   def mask(self, df): return pd.Series(False, index=df.index)
+  def __repr__(self): return 'FALSE'
 
 TRUE: Final[_TRUE] = _TRUE()
 FALSE: Final[_FALSE] = _FALSE()
@@ -177,7 +179,10 @@ class _ContainerConstraint(Constraint):
       self.cs = cs[0]
     else:
       self.cs = cs
-    self.cs: Iterable[Constraint] = map(ensure_constraint, self.cs)
+    self.cs: list[Constraint] = list(map(ensure_constraint, self.cs))
+
+  def __repr__(self):
+    return f"{type(self).__name__}({', '.join(map(repr, self.cs))})"
   
 class NOT(Constraint):
   """Match object if constraint `c` does not match."""
@@ -189,6 +194,9 @@ class NOT(Constraint):
 
   def mask(self, df):
     return ~self.c.mask(df)
+
+  def __repr__(self):
+    return f'NOT({self.c!r})'
     
 class OR(_ContainerConstraint):
   """Match object if any constraint `cs` matches."""
@@ -233,6 +241,9 @@ class EQ(Constraint):
   def mask(self, df):
     return df == self.obj
 
+  def __repr__(self):
+    return f'EQ({self.obj!r})'
+
 class SATISFIES(Constraint):
   """Match object if calling `func` on it returns True."""
   def __init__(self, func: Callable):
@@ -241,6 +252,12 @@ class SATISFIES(Constraint):
   def __contains__(self, obj):
     return bool(self.func(obj))
 
+  def __repr__(self):
+    name = getattr(self.func, '__qualname__', None)
+    if name is None:
+      return f'SATISFIES({self.func!r})'
+    return f'SATISFIES({self.func.__module__}.{name})'
+
 class ISIN(Constraint):
   """Match object if it is in `members`."""
   def __init__(self, members: Collection):
@@ -252,6 +269,15 @@ class ISIN(Constraint):
   def mask(self, df):
     return OR(map(EQ, self.members)).mask(df)
 
+  def __repr__(self):
+    members = self.members
+    if isinstance(members, (set, frozenset)):
+      try:
+        members = sorted(members)
+      except TypeError:
+        members = sorted(members, key=repr)
+    return f'{type(self).__name__}({members!r})'
+
 class MEMBER(ISIN):
   """Match object if it is in `members`.
 
@@ -269,6 +295,9 @@ class CONTAINS(Constraint):
   def __contains__(self, obj):
     return any(e in self.c for e in obj)
 
+  def __repr__(self):
+    return f'CONTAINS({self.c!r})'
+
 class RANGE(Constraint):
   """Match object if between `lb` and `ub`.
 
@@ -301,6 +330,9 @@ class RANGE(Constraint):
       m &= (self.ub > df) if self.ub_strict else (self.ub >= df)
     return m
 
+  def __repr__(self):
+    return f'RANGE({self.lb!r}, {self.ub!r}, lb_strict={self.lb_strict!r}, ub_strict={self.ub_strict!r})'
+
 _K = TypeVar('_K')
 _V1 = TypeVar('_V1')
 _V2 = TypeVar('_V2')
@@ -343,6 +375,9 @@ class FIELD(Constraint):
         df = df[m_new]
     return m
 
+  def __repr__(self):
+    return f"FIELD({', '.join(f'{k}={v!r}' for k, v in sorted(self.fields.items()))})"
+
 _C = TypeVar('_C', bound=Constraint)
 ConstraintLike: TypeAlias = Constraint|Any
 @overload
@@ -0,0 +1,133 @@
+from typing import *
+
+import numpy as np
+
+"""
+
+This module fits the same model to many independent data sets at once
+with a batched Levenberg-Marquardt solver.
+
+Instead of one `scipy.optimize.curve_fit` call per unit, the
+parameters of all units are stacked into a (batch, parameter) array
+and every iteration updates all of them with batched NumPy linear
+algebra.
+
+A model is a function `model(params, x)` of the stacked parameters
+and the shared sample points, returning both the (batch, sample)
+predictions and their (batch, sample, parameter) Jacobian.
+
+"""
+
+class BatchedFit(NamedTuple):
+  """Result of `batched_least_squares`.
+
+  `params` has one row per data set.  `sse` is the weighted sum of
+  squared residuals, and `r2` the coefficient of determination, of
+  each data set.  `converged` is True for the data sets which met a
+  stopping criterion of `batched_least_squares`, and False for those
+  which ran out of iterations or could not be improved any further
+  away from a minimum.
+
+  """
+  params: np.ndarray
+  sse: np.ndarray
+  r2: np.ndarray
+  converged: np.ndarray
+  n_iter: int
+
+def batched_least_squares(model: Callable[[np.ndarray, Any], tuple[np.ndarray, np.ndarray]],
+                          x: Any,
+                          y: np.ndarray,
+                          params0: np.ndarray,
+                          weights: Optional[np.ndarray] = None,
+                          project: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+                          max_iter: int = 100,
+                          tol: float = 1e-8,
+                          gtol: float = 1e-3,
+                          damping: float = 1e-3) -> BatchedFit:
+  """Fit `model` to each row of `y` by Levenberg-Marquardt.
+
+  `y` has shape (batch, sample) and `params0` (batch, parameter).
+  `weights`, of the shape of `y`, weigh the squared residuals; NaN
+  entries of `y` are given a weight of 0.  If given, `project` maps
+  proposed parameters back into their valid domain (e.g. clipping
+  widths to be positive).
+
+  Each data set keeps its own damping factor, and stops being updated
+  once it converges: when its relative decrease in cost falls below
+  `tol`, when its cost falls below `tol` times its total sum of
+  squares (an exact fit), or when its gradient is orthogonal to the
+  residuals to within `gtol` (the cosine of their angle), ignoring
+  the parameters which `project` holds at a bound.
+
+  """
+  y = np.asarray(y, dtype=float)
+  params = np.array(params0, dtype=float)
+  w = np.ones_like(y) if weights is None else np.asarray(weights, dtype=float).copy()
+  missing = np.isnan(y)
+  w[missing] = 0.0
+  y = np.where(missing, 0.0, y)
+  sqrt_w = np.sqrt(w)
+  weighted_mean = np.sum(w * y, axis=1) / np.maximum(np.sum(w, axis=1), 1e-300)
+  sst = np.sum(w * (y - weighted_mean[:, None]) ** 2, axis=1)
+
+  n_params = params.shape[1]
+  eye = np.eye(n_params)
+  lam = np.full(len(params), damping)
+  active = np.ones(len(params), dtype=bool)
+  converged = np.zeros(len(params), dtype=bool)
+
+  def cost(p):
+    pred, jac = model(p, x)
+    r = (pred - y) * sqrt_w
+    return np.sum(r ** 2, axis=1), r, jac * sqrt_w[..., None]
+
+  def gradient_cosine(p, sse, jtj, jtr):
+    "Return the largest cosine between the residuals and a free column of the Jacobian."
+    g = jtr
+    if project is not None:
+      # Moving along -g is blocked for the parameters held at a bound.
+      delta = 1e-8 * (1 + np.abs(p)) * np.sign(g)
+      g = np.where(project(p - delta) == p, 0.0, g)
+    norms = np.sqrt(np.einsum('bpp->bp', jtj) * sse[:, None])
+    with np.errstate(invalid='ignore', divide='ignore'):
+      return np.max(np.where(norms > 0, np.abs(g) / norms, 0.0), axis=1)
+
+  sse, r, jac = cost(params)
+  n_iter = 0
+  while True:
+    jtj = np.einsum('bnp,bnq->bpq', jac, jac)
+    jtr = np.einsum('bnp,bn->bp', jac, r)
+    stationary = active & ((sse <= tol * sst) | (gradient_cosine(params, sse, jtj, jtr) <= gtol))
+    converged |= stationary
+    active &= ~stationary
+    if not active.any() or n_iter == max_iter:
+      break
+    n_iter += 1
+
+    diag = np.einsum('bpp->bp', jtj)[:, :, None] * eye
+    lhs = jtj + lam[:, None, None] * (diag + 1e-12 * eye)
+    try:
+      step = np.linalg.solve(lhs, -jtr[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+      step = (np.linalg.pinv(lhs) @ -jtr[..., None])[..., 0]
+    step[~active] = 0.0
+
+    proposal = params + step
+    if project is not None:
+      proposal = project(proposal)
+    new_sse, new_r, new_jac = cost(proposal)
+
+    better = active & np.isfinite(new_sse) & (new_sse < sse)
+    done = better & (sse - new_sse <= tol * np.maximum(sse, 1e-300))
+    stuck = active & ~better & (lam > 1e10)
+
+    params[better] = proposal[better]
+    sse[better], r[better], jac[better] = new_sse[better], new_r[better], new_jac[better]
+    lam = np.where(better, lam / 10, np.where(active, lam * 10, lam))
+    converged |= done
+    active &= ~(done | stuck)
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    r2 = 1 - sse / sst
+  return BatchedFit(params, sse, r2, converged, n_iter)
@@ -0,0 +1,335 @@
+from typing import *
+import pathlib
+
+import h5py
+import numpy as np
+import pandas as pd
+import scipy.signal
+
+from constraints import *
+
+"""
+
+This module provides a streaming pipeline for the local field
+potential (LFP) of a probe.
+
+`Session.get_lfp` loads the whole LFP of a probe into memory at once,
+which takes gigabytes for a single probe.  Instead, the LFP is read
+from the probe's NWB file in time chunks and cached to a
+memory-mapped float32 array with `cache_lfp`.  Stimulus-locked band
+power is then computed from the cache by `get_lfp_band_power`, one
+chunk of presentations at a time.
+
+Only the functions taking a `session` need the AllenSDK dataset; those
+working from an NWB file or an `LfpCache` do not.
+
+Example:
+
+  If you wanted the theta and gamma power on every channel of a probe
+  during the first 250ms of each static grating presentation, you
+  would call
+  ```
+    df = get_lfp_band_power(probe_id,
+                            bands={'theta': (4, 8), 'gamma': (30, 80)},
+                            stimulus_name='static_gratings')
+  ```
+  and the resulting table can be narrowed further with `filter_df`:
+  ```
+    filter_df(df, ecephys_structure_acronym='VISp',
+                  orientation=AND(NOT(EQ('null')), RANGE(0, 90)))
+  ```
+
+"""
+
+LFP_CACHE_DIR: Final[pathlib.Path] = pathlib.Path('./allendata/lfp_cache/')
+"""Path to the memory-mapped LFP cache, relative to project root."""
+
+LFP_CHUNK_SIZE: Final[int] = 1 << 16
+"""Default number of LFP samples held in memory at once."""
+
+LFP_BANDS: Final[dict[str, tuple[float, float]]] = {
+  'theta': (4.0, 8.0),
+  'alpha': (8.0, 12.0),
+  'beta': (12.0, 30.0),
+  'gamma': (30.0, 80.0),
+}
+"""Default frequency bands, in Hz, used by `get_lfp_band_power`."""
+
+class LfpCache(NamedTuple):
+  """Memory-mapped LFP of a probe.
+
+  `data` has one row per sample and one column per channel, with the
+  corresponding times in `timestamps` and channel ids in
+  `channel_ids`.
+
+  """
+  data: np.ndarray
+  timestamps: np.ndarray
+  channel_ids: np.ndarray
+  sampling_rate: float
+
+def _find_electrical_series(f: h5py.File) -> h5py.Group:
+  "Return the first group of `f` holding both `data` and `timestamps`."
+  found = []
+  def visit(name, obj):
+    if isinstance(obj, h5py.Group) and 'data' in obj and 'timestamps' in obj:
+      found.append(obj)
+      return True
+  f['acquisition'].visititems(visit)
+  if not found:
+    raise ValueError(f"No LFP electrical series found in {f.filename}")
+  return found[0]
+
+def _read_channel_ids(f: h5py.File, series: h5py.Group) -> np.ndarray:
+  "Return the ids of the channels (columns) of the `series` LFP data."
+  n_channels = series['data'].shape[1]
+  if 'electrodes' not in series:
+    return np.arange(n_channels)
+  rows = series['electrodes'][:]
+  table_ids = f['general/extracellular_ephys/electrodes/id'][:]
+  return table_ids[rows]
+
+def get_lfp_nwb_path(probe_id: int, session = None) -> pathlib.Path:
+  """Return the path of the LFP NWB file of `probe_id`, downloading it if needed.
+
+  The file is looked up where `EcephysProjectCache` stores it in
+  `dataset.DATA_DIR`.  Otherwise it is downloaded through the session,
+  which relies on AllenSDK internals; if that fails, download the file
+  yourself and pass its path as `nwb_path` to `cache_lfp`.
+
+  Raises `ValueError` if the probe has no LFP data, and `RuntimeError`
+  if the file cannot be found or downloaded.  By default `session` is
+  `dataset.CURRENT_SESSION`.
+
+  """
+  from dataset import DATA_DIR
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  if not session.probes.loc[probe_id, 'has_lfp_data']:
+    raise ValueError(f"Probe {probe_id} has no LFP data")
+  path = DATA_DIR / f'session_{session.ecephys_session_id}' / f'probe_{probe_id}_lfp.nwb'
+  if path.exists():
+    return path
+  return _download_lfp_nwb(probe_id, session)
+
+def _download_lfp_nwb(probe_id: int, session) -> pathlib.Path:
+  "Download the LFP NWB file of `probe_id` through the session's private API."
+  # The AllenSDK only exposes the LFP file through `session.get_lfp`,
+  # which loads all of it into memory.
+  try:
+    get_path = session.api._probe_lfp_paths[probe_id]
+  except (AttributeError, KeyError):
+    raise RuntimeError(f"Cannot locate the LFP NWB file of probe {probe_id} with this AllenSDK version; "
+                       "pass its path as `nwb_path`")
+  return pathlib.Path(get_path())
+
+def iter_lfp_chunks(nwb_path: str|pathlib.Path,
+                    chunk_size: int = LFP_CHUNK_SIZE,
+                    start: int = 0,
+                    stop: Optional[int] = None) -> Iterator[tuple[int, np.ndarray]]:
+  """Iterate over the LFP of `nwb_path` in chunks of `chunk_size` samples.
+
+  Yields pairs of the index of the first sample of the chunk and the
+  float32 chunk itself, with one row per sample and one column per
+  channel.  Only samples in `[start, stop)` are read.
+
+  """
+  with h5py.File(nwb_path, 'r') as f:
+    data = _find_electrical_series(f)['data']
+    conversion = data.attrs.get('conversion', 1.0)
+    stop = data.shape[0] if stop is None else min(stop, data.shape[0])
+    for lo in range(start, stop, chunk_size):
+      chunk = data[lo:min(lo + chunk_size, stop)].astype(np.float32)
+      if conversion != 1.0:
+        chunk *= np.float32(conversion)
+      yield lo, chunk
+
+def _cache_paths(probe_id: int, cache_dir: pathlib.Path) -> tuple[pathlib.Path, pathlib.Path, pathlib.Path]:
+  stem = f'probe_{probe_id}_lfp'
+  return (cache_dir / f'{stem}.f32',
+          cache_dir / f'{stem}_timestamps.npy',
+          cache_dir / f'{stem}_channels.npy')
+
+def cache_lfp(probe_id: int,
+              nwb_path: Optional[str|pathlib.Path] = None,
+              cache_dir: pathlib.Path = LFP_CACHE_DIR,
+              chunk_size: int = LFP_CHUNK_SIZE,
+              overwrite: bool = False,
+              session = None) -> LfpCache:
+  """Return the memory-mapped LFP of `probe_id`, building the cache if needed.
+
+  The LFP is read from `nwb_path` (by default the probe's LFP NWB file
+  in `session`, see `get_lfp_nwb_path`) `chunk_size` samples at a
+  time, so at most one chunk is held in memory.  If `overwrite` is
+  True, an existing cache is rebuilt.
+
+  """
+  data_path, timestamps_path, channels_path = _cache_paths(probe_id, cache_dir)
+  if overwrite or not (data_path.exists() and timestamps_path.exists() and channels_path.exists()):
+    if nwb_path is None:
+      nwb_path = get_lfp_nwb_path(probe_id, session=session)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    with h5py.File(nwb_path, 'r') as f:
+      series = _find_electrical_series(f)
+      shape = series['data'].shape
+      timestamps = series['timestamps'][:]
+      channel_ids = _read_channel_ids(f, series)
+
+    tmp_path = data_path.with_suffix('.tmp')
+    mm = np.memmap(tmp_path, dtype=np.float32, mode='w+', shape=shape)
+    for lo, chunk in iter_lfp_chunks(nwb_path, chunk_size=chunk_size):
+      mm[lo:lo + len(chunk)] = chunk
+    mm.flush()
+    del mm
+    np.save(timestamps_path, timestamps)
+    np.save(channels_path, channel_ids)
+    tmp_path.replace(data_path)
+
+  timestamps = np.load(timestamps_path, mmap_mode='r')
+  channel_ids = np.load(channels_path)
+  data = np.memmap(data_path, dtype=np.float32, mode='r',
+                   shape=(len(timestamps), len(channel_ids)))
+  sampling_rate = (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+  return LfpCache(data, timestamps, channel_ids, float(sampling_rate))
+
+def _welch_band_power(segments: np.ndarray, fs: float,
+                      bands: Sequence[tuple[float, float]],
+                      nperseg: Optional[int]) -> np.ndarray:
+  "Return the (presentation, channel, band) Welch power of `segments`."
+  n_samples = segments.shape[1]
+  nperseg = n_samples if nperseg is None else min(nperseg, n_samples)
+  freqs, psd = scipy.signal.welch(segments, fs=fs, nperseg=nperseg, axis=1)
+  df = freqs[1] - freqs[0]
+  return np.stack([psd[:, (lo <= freqs) & (freqs < hi)].sum(axis=1) * df
+                   for lo, hi in bands], axis=-1)
+
+def compute_lfp_band_power(lfp: LfpCache,
+                           onset_times: np.ndarray,
+                           window: tuple[float, float] = (0.0, 0.25),
+                           bands: Mapping[str, tuple[float, float]] = LFP_BANDS,
+                           method: Literal['welch', 'hilbert'] = 'welch',
+                           chunk_size: int = LFP_CHUNK_SIZE,
+                           overlap: Optional[float] = None,
+                           nperseg: Optional[int] = None) -> np.ndarray:
+  """Return the band power of `lfp` around each of `onset_times`.
+
+  The result has shape (presentation, channel, band), following the
+  order of `onset_times`, `lfp.channel_ids` and `bands`.  Each
+  presentation contributes the samples in
+  `[onset + window[0], onset + window[1])`; presentations whose window
+  falls outside of the recording are NaN.
+
+  With `method='welch'`, the power is integrated from the Welch power
+  spectral density of each window (using segments of `nperseg`
+  samples, by default the whole window).  With `method='hilbert'`, the
+  LFP is band-pass filtered and the power is the mean squared
+  amplitude of its analytic signal over each window.
+
+  Presentations are processed in chunks spanning at most `chunk_size`
+  samples.  For `'hilbert'`, each chunk is extended by `overlap`
+  seconds on both sides (by default ten cycles of the lowest
+  frequency) so that filter edge effects do not reach the windows.
+
+  """
+  onset_times = np.asarray(onset_times, dtype=float)
+  fs = lfp.sampling_rate
+  n_total, n_channels = lfp.data.shape
+  band_limits = list(bands.values())
+  n_samples = int(round((window[1] - window[0]) * fs))
+  if n_samples <= 0:
+    raise ValueError(f"Empty window {window}")
+
+  if method == 'welch':
+    pad = 0
+  elif method == 'hilbert':
+    if overlap is None:
+      overlap = 10 / min(lo for lo, _ in band_limits)
+    pad = int(np.ceil(overlap * fs))
+    nyquist = fs / 2
+    sos = [scipy.signal.butter(4, [lo / nyquist, min(hi / nyquist, 0.99)], btype='bandpass', output='sos')
+           for lo, hi in band_limits]
+  else:
+    raise ValueError(f"Invalid method {method!r}")
+  if chunk_size < n_samples:
+    raise ValueError(f"`chunk_size` ({chunk_size}) is shorter than the window ({n_samples} samples)")
+
+  power = np.full((len(onset_times), n_channels, len(band_limits)), np.nan)
+
+  starts = np.searchsorted(lfp.timestamps, onset_times + window[0])
+  valid = ((onset_times + window[0] >= lfp.timestamps[0])
+           & (onset_times + window[1] <= lfp.timestamps[-1])
+           & (starts + n_samples <= n_total))
+  order = np.flatnonzero(valid)[np.argsort(starts[valid], kind='stable')]
+  sorted_starts = starts[order]
+  offsets = np.arange(n_samples)
+
+  i = 0
+  while i < len(order):
+    # Greedily take every window which fits in a chunk starting at this one.
+    j = max(np.searchsorted(sorted_starts, sorted_starts[i] + chunk_size - n_samples, side='right'), i + 1)
+    lo = max(sorted_starts[i] - pad, 0)
+    hi = min(sorted_starts[j - 1] + n_samples + pad, n_total)
+    chunk = np.asarray(lfp.data[lo:hi])
+    index = (sorted_starts[i:j] - lo)[:, None] + offsets
+
+    if method == 'welch':
+      chunk_power = _welch_band_power(chunk[index], fs, band_limits, nperseg)
+    else:
+      chunk_power = np.stack([
+        np.mean(np.abs(scipy.signal.hilbert(scipy.signal.sosfiltfilt(s, chunk, axis=0), axis=0))[index] ** 2, axis=1)
+        for s in sos
+      ], axis=-1)
+
+    power[order[i:j]] = chunk_power
+    i = j
+
+  return power
+
+def get_lfp_band_power(probe_id: int,
+                       window: tuple[float, float] = (0.0, 0.25),
+                       bands: Mapping[str, tuple[float, float]] = LFP_BANDS,
+                       method: Literal['welch', 'hilbert'] = 'welch',
+                       channel_columns: None|set[str] = {'ecephys_structure_acronym'},
+                       chunk_size: int = LFP_CHUNK_SIZE,
+                       lfp: Optional[LfpCache] = None,
+                       session = None,
+                       **kwargs):
+  """Return a table of the LFP band power for each stimulus presentation and channel.
+
+  The table has one row per (stimulus_presentation_id, channel_id)
+  pair, one column per band in `bands` and the stimulus presentation
+  columns, so that it can be narrowed with `filter_df`.  If
+  `channel_columns` is None, all the `session.channels` columns are
+  merged as well, otherwise only those in `channel_columns` are.
+
+  See `compute_lfp_band_power` for `window`, `bands`, `method` and
+  `chunk_size`.  The LFP is read from `lfp`, by default the cache of
+  `probe_id` built by `cache_lfp`.  By default `session` is
+  `dataset.CURRENT_SESSION`.
+
+  All filters which `get_stimulus_presentations` accepts are
+  meaningful.
+
+  """
+  from dataset import get_stimulus_presentations
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  if lfp is None:
+    lfp = cache_lfp(probe_id, chunk_size=chunk_size, session=session)
+
+  presentations = get_stimulus_presentations(session=session, **kwargs)
+  power = compute_lfp_band_power(lfp, presentations['start_time'].to_numpy(),
+                                 window=window, bands=bands, method=method,
+                                 chunk_size=chunk_size)
+
+  n_presentations, n_channels, _ = power.shape
+  df = pd.DataFrame(power.reshape(n_presentations * n_channels, -1), columns=list(bands))
+  df.insert(0, 'stimulus_presentation_id', np.repeat(presentations.index.to_numpy(), n_channels))
+  df.insert(1, 'channel_id', np.tile(lfp.channel_ids, n_presentations))
+
+  df = df.merge(presentations, left_on='stimulus_presentation_id', right_index=True)
+  channels = session.channels
+  if channel_columns is not None:
+    channels = channels[list(channel_columns)]
+  return df.merge(channels, how='left', left_on='channel_id', right_index=True)
@@ -0,0 +1,297 @@
+from typing import *
+
+import numpy as np
+import pandas as pd
+
+from constraints import *
+
+"""
+
+This module computes the conditionwise spike statistics of
+`get_conditionwise_spike_statistics` incrementally, without
+materialising the presentationwise spike table.
+
+A `ConditionwiseSpikeAccumulator` is fed stimulus presentations and
+spikes in arrival order.  Each spike is counted into the presentation
+it falls in, and once a presentation is over its spike counts are
+folded into running (Welford) means and variances for each
+(stimulus_condition_id, unit_id) pair.  All updates are vectorized
+over batches of spikes and presentations.
+
+Accumulators fed with disjoint parts of a session (e.g. in parallel)
+can be combined with `merge`, and `snapshot` returns the statistics in
+the same schema as `get_conditionwise_spike_statistics` at any time.
+
+Example:
+
+  ```
+    acc = ConditionwiseSpikeAccumulator(get_unit_ids(), use_rates=True)
+    for presentations, spike_times, spike_unit_ids in stream:
+      acc.add_presentations(presentations.index,
+                            presentations['start_time'],
+                            presentations['stop_time'],
+                            presentations['stimulus_condition_id'])
+      acc.add_spikes(spike_times, spike_unit_ids)
+    acc.flush()
+    acc.snapshot()
+  ```
+
+"""
+
+class ConditionwiseSpikeAccumulator():
+  """Online per-unit, per-condition spike statistics.
+
+  `unit_ids` are the units whose spikes are counted; spikes of other
+  units are ignored.  If `use_rates` is True, the statistics are
+  computed on firing rates, otherwise on spike counts, as in
+  `get_conditionwise_spike_statistics`.
+
+  Presentations must be added before (or along with) the spikes which
+  fall in them, and no presentation may overlap another.
+
+  """
+  def __init__(self, unit_ids: Iterable[int], use_rates: bool = False):
+    self.unit_ids = np.unique(np.asarray(unit_ids))
+    self.use_rates = use_rates
+    n_units = len(self.unit_ids)
+
+    # Closed presentations, one row per stimulus condition.
+    self.condition_ids = np.empty(0, dtype=np.int64)
+    self.n = np.zeros(0, dtype=np.int64)
+    self.spike_count = np.zeros((0, n_units), dtype=np.int64)
+    self.mean = np.zeros((0, n_units))
+    self.m2 = np.zeros((0, n_units))
+
+    # Open presentations, sorted by start time.
+    self._ids = np.empty(0, dtype=np.int64)
+    self._starts = np.empty(0)
+    self._stops = np.empty(0)
+    self._conditions = np.empty(0, dtype=np.int64)
+    self._counts = np.zeros((0, n_units), dtype=np.int64)
+
+  def _condition_rows(self, condition_ids: np.ndarray) -> np.ndarray:
+    "Return the rows of `condition_ids`, adding the unknown ones."
+    new = np.setdiff1d(condition_ids, self.condition_ids)
+    if len(new):
+      n_units = len(self.unit_ids)
+      self.condition_ids = np.concatenate([self.condition_ids, new])
+      self.n = np.concatenate([self.n, np.zeros(len(new), dtype=np.int64)])
+      self.spike_count = np.concatenate([self.spike_count, np.zeros((len(new), n_units), dtype=np.int64)])
+      self.mean = np.concatenate([self.mean, np.zeros((len(new), n_units))])
+      self.m2 = np.concatenate([self.m2, np.zeros((len(new), n_units))])
+    return pd.Index(self.condition_ids).get_indexer(condition_ids)
+
+  def add_presentations(self,
+                        stimulus_presentation_ids: Iterable[int],
+                        start_times: Iterable[float],
+                        stop_times: Iterable[float],
+                        stimulus_condition_ids: Iterable[int]):
+    "Open new stimulus presentations."
+    ids = np.asarray(stimulus_presentation_ids, dtype=np.int64)
+    starts = np.asarray(start_times, dtype=float)
+    stops = np.asarray(stop_times, dtype=float)
+    conditions = self._condition_rows(np.asarray(stimulus_condition_ids, dtype=np.int64))
+
+    self._ids = np.concatenate([self._ids, ids])
+    self._starts = np.concatenate([self._starts, starts])
+    self._stops = np.concatenate([self._stops, stops])
+    self._conditions = np.concatenate([self._conditions, conditions])
+    self._counts = np.concatenate([self._counts, np.zeros((len(ids), len(self.unit_ids)), dtype=np.int64)])
+    if len(self._starts) > 1 and np.any(np.diff(self._starts) < 0):
+      order = np.argsort(self._starts, kind='stable')
+      self._ids, self._starts, self._stops, self._conditions, self._counts = \
+        self._ids[order], self._starts[order], self._stops[order], self._conditions[order], self._counts[order]
+
+  def add_spikes(self, spike_times: Iterable[float], unit_ids: Iterable[int], advance: bool = True):
+    """Count spikes into the open presentations they fall in.
+
+    Presentations span `[start_time, stop_time)`.  If `advance` is
+    True, the spikes are taken to be in arrival order, and the
+    presentations which are over by the last of them are closed.
+
+    """
+    times = np.asarray(spike_times, dtype=float)
+    units = np.asarray(unit_ids)
+    if len(times) == 0:
+      return
+
+    unit_rows = np.searchsorted(self.unit_ids, units)
+    unit_rows[unit_rows == len(self.unit_ids)] = 0
+    known = self.unit_ids[unit_rows] == units if len(self.unit_ids) else np.zeros(len(units), dtype=bool)
+    rows = np.searchsorted(self._starts, times, side='right') - 1
+    inside = known & (rows >= 0)
+    inside[inside] &= times[inside] < self._stops[rows[inside]]
+    np.add.at(self._counts, (rows[inside], unit_rows[inside]), 1)
+
+    if advance:
+      self.advance(times.max())
+
+  def advance(self, time: float):
+    "Close the open presentations which stop at or before `time`."
+    closed = self._stops <= time
+    if not closed.any():
+      return
+
+    counts = self._counts[closed]
+    conditions = self._conditions[closed]
+    values = counts.astype(float)
+    if self.use_rates:
+      values /= (self._stops[closed] - self._starts[closed])[:, None]
+
+    # Per-condition statistics of the batch, merged into the running
+    # ones with Chan et al.'s parallel variant of Welford's algorithm.
+    n_b = np.bincount(conditions, minlength=len(self.n))
+    total = np.zeros_like(self.mean)
+    np.add.at(total, conditions, values)
+    touched = n_b > 0
+    mean_b = np.zeros_like(self.mean)
+    mean_b[touched] = total[touched] / n_b[touched, None]
+    m2_b = np.zeros_like(self.m2)
+    np.add.at(m2_b, conditions, (values - mean_b[conditions]) ** 2)
+    np.add.at(self.spike_count, conditions, counts)
+    self._combine(n_b, mean_b, m2_b)
+
+    keep = ~closed
+    self._ids, self._starts, self._stops, self._conditions, self._counts = \
+      self._ids[keep], self._starts[keep], self._stops[keep], self._conditions[keep], self._counts[keep]
+
+  def flush(self):
+    "Close all the open presentations."
+    if len(self._stops):
+      self.advance(self._stops.max())
+
+  def _combine(self, n_b: np.ndarray, mean_b: np.ndarray, m2_b: np.ndarray):
+    "Merge the per-condition statistics `n_b`, `mean_b`, `m2_b` into the running ones."
+    n_a = self.n
+    n = n_a + n_b
+    touched = n_b > 0
+    delta = mean_b[touched] - self.mean[touched]
+    w_a = (n_a[touched] / n[touched])[:, None]
+    w_b = (n_b[touched] / n[touched])[:, None]
+    self.mean[touched] += delta * w_b
+    self.m2[touched] += m2_b[touched] + delta ** 2 * w_a * n_b[touched, None]
+    self.n = n
+
+  def merge(self, other: 'ConditionwiseSpikeAccumulator') -> 'ConditionwiseSpikeAccumulator':
+    """Merge the statistics of `other` into this accumulator and return it.
+
+    Both accumulators must track the same units and statistic, and a
+    presentation closed in one of them must not have been added to the
+    other.  The open presentations of `other` are added to those of
+    this accumulator, with the counts of presentations open in both
+    summed.
+
+    """
+    if not np.array_equal(self.unit_ids, other.unit_ids) or self.use_rates != other.use_rates:
+      raise ValueError("Cannot merge accumulators over different units or statistics")
+
+    rows = self._condition_rows(other.condition_ids)
+    n_b = np.zeros_like(self.n)
+    n_b[rows] = other.n
+    mean_b = np.zeros_like(self.mean)
+    mean_b[rows] = other.mean
+    m2_b = np.zeros_like(self.m2)
+    m2_b[rows] = other.m2
+    self.spike_count[rows] += other.spike_count
+    self._combine(n_b, mean_b, m2_b)
+
+    if len(other._ids):
+      shared = np.isin(other._ids, self._ids)
+      self.add_presentations(other._ids[~shared], other._starts[~shared], other._stops[~shared],
+                             other.condition_ids[other._conditions[~shared]])
+      order = np.argsort(self._ids)
+      self._counts[order[np.searchsorted(self._ids, other._ids, sorter=order)]] += other._counts
+    return self
+
+  def snapshot(self) -> pd.DataFrame:
+    """Return the statistics of the closed presentations.
+
+    The table has the schema of `get_conditionwise_spike_statistics`:
+    it is indexed by (unit_id, stimulus_condition_id), with columns
+    - spike_count                    (integer, total over presentations)
+    - stimulus_presentation_count    (integer)
+    - spike_mean                     (float)
+    - spike_std                      (float, NaN for a single presentation)
+    - spike_sem                      (float, NaN for a single presentation)
+
+    """
+    order = np.argsort(self.condition_ids, kind='stable')
+    order = order[self.n[order] > 0]
+    n_conditions, n_units = len(order), len(self.unit_ids)
+    n = np.repeat(self.n[order], n_units)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      std = np.sqrt(self.m2[order].ravel() / (n - 1))
+    std[n < 2] = np.nan
+    return pd.DataFrame({
+      'stimulus_condition_id': np.repeat(self.condition_ids[order], n_units),
+      'unit_id': np.tile(self.unit_ids, n_conditions),
+      'spike_count': self.spike_count[order].ravel(),
+      'stimulus_presentation_count': n,
+      'spike_mean': self.mean[order].ravel(),
+      'spike_std': std,
+      'spike_sem': std / np.sqrt(n),
+    }).set_index(['unit_id', 'stimulus_condition_id'])
+
+  def tuning_curves(self, condition_values: Mapping[int, Any]|pd.Series) -> pd.DataFrame:
+    """Return the unit × value table of the mean response to each value of `condition_values`.
+
+    `condition_values` maps each stimulus condition id to a stimulus
+    parameter, e.g. its orientation.  The mean response to a value is
+    the mean over all the closed presentations of the conditions
+    mapped to it.  Unmapped conditions are left out.
+
+    """
+    values = pd.Series(self.condition_ids, name=getattr(condition_values, 'name', None)).map(condition_values)
+    mapped = values.notna().to_numpy() & (self.n > 0)
+    labels, groups = np.unique(values[mapped].to_numpy(), return_inverse=True)
+    n = np.bincount(groups, weights=self.n[mapped], minlength=len(labels))
+    total = np.zeros((len(labels), len(self.unit_ids)))
+    np.add.at(total, groups, self.mean[mapped] * self.n[mapped, None])
+    return pd.DataFrame((total / n[:, None]).T,
+                        index=pd.Index(self.unit_ids, name='unit_id'),
+                        columns=pd.Index(labels, name=values.name))
+
+def replay_conditionwise_spike_statistics(use_rates: Optional[bool] = False,
+                                          chunk_duration: float = 60.0,
+                                          session = None,
+                                          **kwargs) -> pd.DataFrame:
+  """Return the conditionwise spike statistics computed by replaying `session`.
+
+  The spikes and stimulus presentations are fed to a
+  `ConditionwiseSpikeAccumulator` in chunks of `chunk_duration`
+  seconds, as if they were arriving live, and the result is the same
+  table as `get_conditionwise_spike_statistics` returns.  By default
+  `session` is `dataset.CURRENT_SESSION`.
+
+  All filters which `get_units` and `get_stimulus_presentations`
+  accept are meaningful.
+
+  """
+  from dataset import get_unit_ids, get_stimulus_presentations
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  kwargs['__total__'] = False
+  unit_ids = get_unit_ids(session=session, **kwargs)
+  presentations = get_stimulus_presentations(session=session, **kwargs).sort_values('start_time')
+  acc = ConditionwiseSpikeAccumulator(unit_ids, use_rates=bool(use_rates))
+  if presentations.empty:
+    return acc.snapshot()
+
+  spike_times = [np.asarray(session.spike_times[unit_id]) for unit_id in unit_ids]
+  edges = np.arange(presentations['start_time'].min(),
+                    presentations['stop_time'].max() + chunk_duration,
+                    chunk_duration)
+  spike_edges = np.array([np.searchsorted(times, edges) for times in spike_times]).reshape(len(unit_ids), len(edges))
+  presentation_edges = np.searchsorted(presentations['start_time'].to_numpy(), edges)
+
+  for i in range(len(edges) - 1):
+    batch = presentations.iloc[presentation_edges[i]:presentation_edges[i + 1]]
+    acc.add_presentations(batch.index, batch['start_time'], batch['stop_time'],
+                          batch['stimulus_condition_id'])
+    lo, hi = spike_edges[:, i], spike_edges[:, i + 1]
+    times = np.concatenate([t[l:h] for t, l, h in zip(spike_times, lo, hi)])
+    units = np.repeat(np.asarray(unit_ids), hi - lo)
+    acc.add_spikes(times, units, advance=False)
+    acc.advance(edges[i + 1])
+  acc.flush()
+  return acc.snapshot()
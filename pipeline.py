@@ -0,0 +1,423 @@
+from typing import *
+import argparse
+import concurrent.futures
+import hashlib
+import inspect
+import pathlib
+import pickle
+import re
+
+import numpy as np
+import pandas as pd
+
+from constraints import Constraint
+
+"""
+
+This module defines a small declarative pipeline runner, where each
+stage is a function of the outputs of the stages it depends on.
+
+The stages form a DAG, and the output of each stage is cached on disk
+under a key hashing the stage's name, source code (and that of the
+functions it declares it uses), parameters and the keys of its
+dependencies.  Changing a stage therefore invalidates it
+and everything downstream of it, while the rest of the pipeline is
+loaded from the cache.  Stages whose dependencies are ready run
+concurrently, so independent branches (e.g. static and drifting
+gratings) do not wait for each other.
+
+Example:
+
+  ```
+    p = Pipeline()
+    p.add('spikes', get_orientation_spike_statistics, stimulus_name='static_gratings')
+    p.add('tuning', get_tuning_curves, deps=['spikes'])
+    outputs = p.run(['tuning'])
+  ```
+
+`build_orientation_pipeline` defines the chain of the OSI notebooks
+(spike statistics → tuning curves → OSI/DSI → significance → unit
+selection → decoding → cross-condition comparison), and running this
+file executes it headlessly:
+```
+  python pipeline.py --jobs 4 --processes
+  python pipeline.py --force tuning_curves/static_gratings
+```
+
+"""
+
+PIPELINE_CACHE_DIR: Final[pathlib.Path] = pathlib.Path('./allendata/pipeline_cache/')
+"""Path to the stage output cache, relative to project root."""
+
+def _source(func: Callable) -> str:
+  "Return the source of `func`, or its qualified name if it has none."
+  try:
+    return inspect.getsource(func)
+  except (OSError, TypeError):
+    return f'{func.__module__}.{func.__qualname__}'
+
+_UNSTABLE_REPR: Final[re.Pattern] = re.compile(r' at 0x[0-9a-fA-F]+|\.\.\.|<lambda>|<locals>')
+
+def _digest(data: bytes) -> str:
+  return hashlib.sha256(data).hexdigest()
+
+def _canonical(obj: Any) -> str:
+  """Return a string identifying the value of `obj`, the same in every process.
+
+  Mappings and sets are sorted, arrays and pandas objects are hashed by
+  content, constraints by their attributes and functions by their
+  source.  Raises `ValueError` for objects which would only be
+  identified by a truncated or address-bearing `repr`, and for lambdas
+  and local functions.
+
+  """
+  if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+    return repr(obj)
+  if isinstance(obj, Mapping):
+    items = sorted((_canonical(k), _canonical(v)) for k, v in obj.items())
+    return '{' + ', '.join(f'{k}: {v}' for k, v in items) + '}'
+  if isinstance(obj, (set, frozenset)):
+    return '{' + ', '.join(sorted(map(_canonical, obj))) + '}'
+  if isinstance(obj, (list, tuple)):
+    return f"{type(obj).__name__}({', '.join(map(_canonical, obj))})"
+  if isinstance(obj, np.ndarray):
+    if obj.dtype.hasobject:
+      return f'ndarray({obj.shape}, {_canonical(obj.tolist())})'
+    return f'ndarray({obj.dtype.str}, {obj.shape}, {_digest(np.ascontiguousarray(obj).tobytes())})'
+  if isinstance(obj, (pd.Index, pd.Series, pd.DataFrame)):
+    hashes = pd.util.hash_pandas_object(obj, index=not isinstance(obj, pd.Index)).to_numpy()
+    header = [type(obj).__name__, list(obj.names) if isinstance(obj, pd.Index) else obj.index.names]
+    if isinstance(obj, pd.DataFrame):
+      header.append(list(obj.columns))
+      header.append([str(dtype) for dtype in obj.dtypes])
+    else:
+      header.append(str(obj.dtype))
+    return f'{_canonical(header)}({_digest(hashes.tobytes())})'
+  if isinstance(obj, Constraint):
+    return f'{type(obj).__name__}({_canonical(vars(obj))})'
+  qualname = getattr(obj, '__qualname__', None) or getattr(obj, '__name__', None)
+  if callable(obj) and isinstance(qualname, str):
+    name = f'{getattr(obj, "__module__", None)}.{qualname}'
+    if '<lambda>' in name or '<locals>' in name:
+      raise ValueError(f"{name} cannot be identified across processes; define it at the top level of a module")
+    return _source(obj) if hasattr(obj, '__code__') else name
+  text = repr(obj)
+  if _UNSTABLE_REPR.search(text):
+    raise ValueError(f"{type(obj).__name__} object has no stable repr: {text}")
+  return text
+
+class Stage():
+  """A pipeline stage.
+
+  Calling the stage calls `func` with the outputs of `deps` as
+  positional arguments, followed by `params` as keyword arguments.
+  `params` are part of the key of the stage, identified by content
+  (arrays and pandas objects by their hash, functions by their source,
+  other objects by a `repr` which must be the same in every process).
+  The source of `func` is part of the key, but not that of the
+  functions it calls, unless they are listed in `uses`.
+
+  """
+  def __init__(self,
+               name: str,
+               func: Callable,
+               deps: Sequence[str] = (),
+               params: Mapping[str, Any] = {},
+               uses: Sequence[Callable] = ()):
+    self.name = name
+    self.func = func
+    self.deps = tuple(deps)
+    self.params = dict(params)
+    self.uses = tuple(uses)
+
+  def __call__(self, *inputs):
+    return self.func(*inputs, **self.params)
+
+  def fingerprint(self) -> str:
+    "Return a string identifying the code and parameters of the stage."
+    source = [_source(func) for func in (self.func, *self.uses)]
+    try:
+      params = _canonical(self.params)
+    except ValueError as e:
+      raise ValueError(f"Parameters of stage {self.name!r} cannot be part of its key: {e}")
+    return repr((self.name, source, params))
+
+def _run_stage(stage: Stage, path: pathlib.Path, *inputs):
+  "Call `stage` on `inputs` and cache its output at `path`."
+  output = stage(*inputs)
+  tmp_path = path.with_suffix('.tmp')
+  with open(tmp_path, 'wb') as f:
+    pickle.dump(output, f)
+  tmp_path.replace(path)
+  return output
+
+class Pipeline():
+  """A DAG of stages with content-hashed cached outputs."""
+
+  def __init__(self, cache_dir: pathlib.Path = PIPELINE_CACHE_DIR):
+    self.cache_dir = pathlib.Path(cache_dir)
+    self.stages: dict[str, Stage] = {}
+
+  def add(self,
+          name: str,
+          func: Callable,
+          deps: Sequence[str] = (),
+          uses: Sequence[Callable] = (),
+          **params) -> Stage:
+    """Add the stage `name` computing `func(*deps, **params)`.
+
+    The dependencies must already be in the pipeline, which keeps it
+    acyclic.  `uses` lists the functions called by `func` whose changes
+    should also invalidate the stage.
+
+    """
+    if name in self.stages:
+      raise ValueError(f"Duplicate stage {name!r}")
+    for dep in deps:
+      if dep not in self.stages:
+        raise ValueError(f"Unknown dependency {dep!r} of stage {name!r}")
+    stage = self.stages[name] = Stage(name, func, deps, params, uses)
+    return stage
+
+  def stage(self, name: Optional[str] = None, deps: Sequence[str] = (), uses: Sequence[Callable] = (), **params):
+    "Decorator form of `add`, defaulting `name` to the function's name."
+    def decorator(func):
+      self.add(func.__name__ if name is None else name, func, deps, uses, **params)
+      return func
+    return decorator
+
+  def check(self, names: Iterable[str]) -> list[str]:
+    "Return `names` as a list, raising a ValueError if any is not a stage."
+    names = list(names)
+    for name in names:
+      if name not in self.stages:
+        raise ValueError(f"Unknown stage {name!r}")
+    return names
+
+  def upstream(self, targets: Iterable[str]) -> list[str]:
+    "Return `targets` and all their dependencies, in topological order."
+    targets = self.check(targets)
+    order, seen = [], set()
+    def visit(name):
+      if name in seen:
+        return
+      seen.add(name)
+      for dep in self.stages[name].deps:
+        visit(dep)
+      order.append(name)
+    for name in targets:
+      visit(name)
+    return order
+
+  def downstream(self, sources: Iterable[str], names: Iterable[str]) -> set[str]:
+    "Return the stages of `names` which are in or depend on `sources`."
+    found = set(self.check(sources))
+    names = self.check(names)
+    for name in self.upstream(names):
+      if any(dep in found for dep in self.stages[name].deps):
+        found.add(name)
+    return found & set(names)
+
+  def keys(self) -> dict[str, str]:
+    "Return the cache key of each stage."
+    keys = {}
+    for name in self.upstream(self.stages):
+      stage = self.stages[name]
+      h = hashlib.sha256(stage.fingerprint().encode())
+      for dep in stage.deps:
+        h.update(keys[dep].encode())
+      keys[name] = h.hexdigest()
+    return keys
+
+  def cache_path(self, name: str, key: str) -> pathlib.Path:
+    return self.cache_dir / f"{name.replace('/', '.')}-{key[:16]}.pkl"
+
+  def stale(self, targets: Optional[Iterable[str]] = None) -> list[str]:
+    "Return the stages needed by `targets` whose output is not cached."
+    keys = self.keys()
+    names = self.upstream(self.stages if targets is None else targets)
+    return [name for name in names if not self.cache_path(name, keys[name]).exists()]
+
+  def run(self,
+          targets: Optional[Iterable[str]] = None,
+          force: Iterable[str] = (),
+          max_workers: Optional[int] = None,
+          processes: bool = False,
+          verbose: bool = False) -> dict[str, Any]:
+    """Run the stages needed by `targets` and return their outputs.
+
+    By default all stages are targets.  Stages with a cached output are
+    loaded instead of run, unless they are in `force` or depend on a
+    stage in `force`.
+
+    Ready stages run concurrently on up to `max_workers` threads, which
+    only helps stages spending their time outside the GIL (NumPy, file
+    I/O).  If `processes` is True, they run in worker processes instead,
+    in which case the stage functions, parameters and outputs must be
+    picklable (the outputs are pickled for the cache anyway).
+
+    """
+    keys = self.keys()
+    names = self.upstream(self.stages if targets is None else targets)
+    force = self.downstream(force, names)
+    outputs: dict[str, Any] = {}
+    pending = {name: set(self.stages[name].deps) for name in names}
+
+    def finish(name, output):
+      outputs[name] = output
+      for deps in pending.values():
+        deps.discard(name)
+
+    executor_class = concurrent.futures.ProcessPoolExecutor if processes else concurrent.futures.ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+      running = {}
+      while pending or running:
+        for name in [name for name, deps in pending.items() if not deps]:
+          del pending[name]
+          path = self.cache_path(name, keys[name])
+          if name not in force and path.exists():
+            if verbose: print(f"{name}: cached")
+            with open(path, 'rb') as f:
+              finish(name, pickle.load(f))
+            continue
+          if verbose: print(f"{name}: running...")
+          stage = self.stages[name]
+          self.cache_dir.mkdir(parents=True, exist_ok=True)
+          running[executor.submit(_run_stage, stage, path, *(outputs[dep] for dep in stage.deps))] = name
+        if not running:
+          continue
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          name = running.pop(future)
+          finish(name, future.result())
+          if verbose: print(f"{name}: done")
+    return outputs
+
+  def prune(self) -> list[pathlib.Path]:
+    "Delete the cached outputs which no stage refers to anymore and return their paths."
+    keys = self.keys()
+    live = {self.cache_path(name, key) for name, key in keys.items()}
+    removed = [path for path in self.cache_dir.glob('*.pkl') if path not in live]
+    for path in removed:
+      path.unlink()
+    return removed
+
+ORIENTATION_CONDITIONS: Final[dict[str, float]] = {
+  'static_gratings': 180.0,
+  'drifting_gratings': 360.0,
+}
+"""Stimuli analysed by `build_orientation_pipeline`, with their orientation period."""
+
+def _session(session_id: Optional[int]):
+  import dataset
+  if session_id is None or session_id == dataset.CURRENT_SESSION_ID:
+    return dataset.CURRENT_SESSION
+  return dataset.CACHE.get_session_data(session_id)
+
+def _spike_statistics(stimulus_name: str, session_id: Optional[int], filters: Mapping[str, Any]):
+  from analysis import get_orientation_spike_statistics
+  return get_orientation_spike_statistics(stimulus_name, session=_session(session_id), **filters)
+
+def _compare_conditions(*inputs, conditions: Sequence[str], session_id: Optional[int]):
+  from analysis import compare_conditions
+  n = len(conditions)
+  return compare_conditions(dict(zip(conditions, inputs[:n])),
+                            dict(zip(conditions, inputs[n:])),
+                            session=_session(session_id))
+
+def build_orientation_pipeline(session_id: Optional[int] = None,
+                               conditions: Mapping[str, float] = ORIENTATION_CONDITIONS,
+                               value_col: str = 'spike_count',
+                               threshold: float = 0.5,
+                               alpha: float = 0.05,
+                               cache_dir: pathlib.Path = PIPELINE_CACHE_DIR,
+                               **filters) -> Pipeline:
+  """Return the pipeline of the OSI notebooks for `session_id`.
+
+  For each stimulus name in `conditions`, the stages are named
+  `'<stage>/<stimulus_name>'`, with `<stage>` one of spike_statistics,
+  tuning_curves, tuning_fit, selectivity, significance, selected_units
+  and decoding.  The final `cross_condition` stage compares all of
+  `conditions`.  A unit is selected if its OSI exceeds `threshold`
+  with an ANOVA p-value below `alpha`.
+
+  By default the session is `dataset.CURRENT_SESSION`.  All filters
+  which `get_units` and `get_stimulus_presentations` accept are
+  meaningful.
+
+  """
+  from analysis import (get_orientation_spike_statistics, get_tuning_curves, get_selectivity_indices,
+                        get_anova_p_values, select_tuned_units, decode_orientation, compare_conditions)
+  from dataset import get_conditionwise_spike_statistics, get_stimulus_presentations, get_units
+  from fitting import batched_least_squares
+  from tuning import fit_tuning_curves, _tuning_model
+
+  p = Pipeline(cache_dir)
+  for stimulus_name, period in conditions.items():
+    p.add(f'spike_statistics/{stimulus_name}', _spike_statistics,
+          uses=[get_orientation_spike_statistics, get_conditionwise_spike_statistics,
+                get_stimulus_presentations, get_units],
+          stimulus_name=stimulus_name, session_id=session_id, filters=filters)
+    p.add(f'tuning_curves/{stimulus_name}', get_tuning_curves,
+          deps=[f'spike_statistics/{stimulus_name}'], value_col=value_col)
+    p.add(f'tuning_fit/{stimulus_name}', fit_tuning_curves,
+          deps=[f'tuning_curves/{stimulus_name}'], uses=[_tuning_model, batched_least_squares],
+          period=period)
+    p.add(f'selectivity/{stimulus_name}', get_selectivity_indices,
+          deps=[f'tuning_curves/{stimulus_name}'], period=period)
+    p.add(f'significance/{stimulus_name}', get_anova_p_values,
+          deps=[f'spike_statistics/{stimulus_name}'], value_col=value_col)
+    p.add(f'selected_units/{stimulus_name}', select_tuned_units,
+          deps=[f'selectivity/{stimulus_name}', f'significance/{stimulus_name}'],
+          threshold=threshold, alpha=alpha)
+    p.add(f'decoding/{stimulus_name}', decode_orientation,
+          deps=[f'spike_statistics/{stimulus_name}', f'selected_units/{stimulus_name}'],
+          value_col=value_col)
+  p.add('cross_condition', _compare_conditions,
+        deps=[f'selectivity/{s}' for s in conditions] + [f'selected_units/{s}' for s in conditions],
+        uses=[compare_conditions, get_units],
+        conditions=list(conditions), session_id=session_id)
+  return p
+
+def main(argv: Optional[Sequence[str]] = None):
+  parser = argparse.ArgumentParser(description="Run the orientation analysis pipeline headlessly.")
+  parser.add_argument('--session-id', type=int, default=None,
+                      help="session to analyse (default: dataset.CURRENT_SESSION_ID)")
+  parser.add_argument('--stages', nargs='*', default=None,
+                      help="target stages (default: all)")
+  parser.add_argument('--force', nargs='*', default=[],
+                      help="stages to rerun even if cached")
+  parser.add_argument('--jobs', type=int, default=None,
+                      help="maximum number of stages run concurrently")
+  parser.add_argument('--processes', action='store_true',
+                      help="run the stages in worker processes rather than threads")
+  parser.add_argument('--threshold', type=float, default=0.5)
+  parser.add_argument('--alpha', type=float, default=0.05)
+  parser.add_argument('--cache-dir', type=pathlib.Path, default=PIPELINE_CACHE_DIR)
+  parser.add_argument('--dry-run', action='store_true',
+                      help="only list the stages which would run")
+  args = parser.parse_args(argv)
+
+  p = build_orientation_pipeline(args.session_id, threshold=args.threshold,
+                                 alpha=args.alpha, cache_dir=args.cache_dir)
+  try:
+    p.check(args.stages or [])
+    p.check(args.force)
+  except ValueError as e:
+    parser.error(str(e))
+  if args.dry_run:
+    names = p.upstream(p.stages if args.stages is None else args.stages)
+    stale = set(p.stale(args.stages)) | p.downstream(args.force, names)
+    for name in names:
+      if name in stale:
+        print(name)
+    return
+  outputs = p.run(args.stages, force=args.force, max_workers=args.jobs,
+                  processes=args.processes, verbose=True)
+  for name, output in outputs.items():
+    if name.startswith('decoding/') or name == 'cross_condition':
+      print(f'=== {name} ===')
+      print(output)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,262 @@
+from typing import *
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+from constraints import *
+from fitting import *
+
+"""
+
+This module maps the spatial receptive fields (RFs) of all units at
+once from the gabor presentations.
+
+The spikes are first reduced to a presentation × unit count matrix
+(`get_presentationwise_spike_counts`), which is then scatter-added
+over the (x_position, y_position) grid of the gabors
+(`get_receptive_fields`).  From there, the significance of every RF
+and a 2-D Gaussian fit of every RF are computed for all units
+together.  Only the `get_*` functions need the AllenSDK dataset.
+
+Example:
+
+  If you wanted the RF location of every unit in VISp whose RF is
+  significant, you would call
+  ```
+    rfs = get_receptive_field_table(ecephys_structure_acronym='VISp')
+    filter_df(rfs, p_value=RANGE(None, 0.01))[['center_x', 'center_y']]
+  ```
+
+"""
+
+def get_presentationwise_spike_counts(window: Optional[tuple[float, float]] = None,
+                                      session = None,
+                                      **kwargs) -> tuple[pd.DataFrame, pd.Index, np.ndarray]:
+  """Return the spike count of each unit during each stimulus presentation.
+
+  Returns the matching stimulus presentations, the matching unit ids,
+  and the (presentation, unit) count matrix following their order.
+  The spikes in `[start_time, stop_time)` are counted or, if `window`
+  is given, those in `[onset + window[0], onset + window[1])`, which
+  may extend past the presentation.  By default `session` is
+  `dataset.CURRENT_SESSION`.
+
+  All filters which `get_units` and `get_stimulus_presentations`
+  accept are meaningful.
+
+  """
+  from dataset import get_stimulus_presentations, get_unit_ids
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  kwargs['session'] = session
+  kwargs['__total__'] = False
+  presentations = get_stimulus_presentations(**kwargs)
+  unit_ids = get_unit_ids(**kwargs)
+
+  # `presentationwise_spike_times` would clip the spikes to the
+  # presentations, so count them from the sorted spike trains instead.
+  if window is None:
+    lo, hi = presentations['start_time'].to_numpy(), presentations['stop_time'].to_numpy()
+  else:
+    lo = presentations['start_time'].to_numpy() + window[0]
+    hi = presentations['start_time'].to_numpy() + window[1]
+  counts = np.empty((len(presentations), len(unit_ids)), dtype=np.int64)
+  for j, unit_id in enumerate(unit_ids):
+    times = session.spike_times[unit_id]
+    counts[:, j] = np.searchsorted(times, hi) - np.searchsorted(times, lo)
+  return presentations, unit_ids, counts
+
+class ReceptiveFields(NamedTuple):
+  """Receptive field maps of a set of units.
+
+  `maps` has shape (unit, y, x) and holds the mean spike count per
+  presentation at each (y_positions, x_positions) grid point, and
+  `presentation_counts` the number of presentations at each point.
+
+  """
+  maps: np.ndarray
+  unit_ids: pd.Index
+  x_positions: np.ndarray
+  y_positions: np.ndarray
+  presentation_counts: np.ndarray
+
+def _grid_positions(presentations: pd.DataFrame) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  "Return the x and y grid values and the flat grid index of each presentation."
+  x_positions, x_index = np.unique(presentations['x_position'].astype(float), return_inverse=True)
+  y_positions, y_index = np.unique(presentations['y_position'].astype(float), return_inverse=True)
+  return x_positions, y_positions, y_index.ravel() * len(x_positions) + x_index.ravel()
+
+def compute_receptive_fields(presentations: pd.DataFrame,
+                             unit_ids: pd.Index,
+                             counts: np.ndarray) -> ReceptiveFields:
+  """Return the receptive fields from a presentation × unit count matrix.
+
+  `presentations`, `unit_ids` and `counts` are as returned by
+  `get_presentationwise_spike_counts`; `presentations` must have
+  numeric `x_position` and `y_position` columns.
+
+  """
+  x_positions, y_positions, position = _grid_positions(presentations)
+  n_positions = len(x_positions) * len(y_positions)
+  totals = np.zeros((n_positions, counts.shape[1]))
+  np.add.at(totals, position, counts)
+  n = np.bincount(position, minlength=n_positions)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    maps = totals / n[:, None]
+  maps = maps.T.reshape(len(unit_ids), len(y_positions), len(x_positions))
+  return ReceptiveFields(maps, unit_ids, x_positions, y_positions,
+                         n.reshape(len(y_positions), len(x_positions)))
+
+def _chi_square_statistic(totals: np.ndarray, n: np.ndarray) -> np.ndarray:
+  "Return the chi-square statistic of the (..., position, unit) `totals` against uniform responses."
+  expected = totals.sum(axis=-2, keepdims=True) * (n / n.sum())[:, None]
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.nansum((totals - expected) ** 2 / expected, axis=-2)
+
+def receptive_field_p_values(presentations: pd.DataFrame,
+                             counts: np.ndarray,
+                             method: Literal['chi2', 'shuffle'] = 'chi2',
+                             n_shuffles: int = 1000,
+                             random_state: Optional[int] = None) -> np.ndarray:
+  """Return, for each unit, the p-value of its response not depending on position.
+
+  The statistic is the chi-square statistic of the spike counts at each
+  grid position against the counts expected if the unit responded
+  equally everywhere.  With `method='chi2'`, the p-value comes from
+  the chi-square distribution; with `method='shuffle'`, it comes from
+  `n_shuffles` random permutations of the positions of the
+  presentations, which does not assume Poisson spike counts.
+
+  """
+  _, _, position = _grid_positions(presentations)
+  n_positions = position.max() + 1
+  n = np.bincount(position, minlength=n_positions)
+  occupied = n > 0
+  totals = np.zeros((n_positions, counts.shape[1]))
+  np.add.at(totals, position, counts)
+  statistic = _chi_square_statistic(totals[occupied], n[occupied])
+
+  if method == 'chi2':
+    return scipy.stats.chi2.sf(statistic, df=occupied.sum() - 1)
+  if method != 'shuffle':
+    raise ValueError(f"Invalid method {method!r}")
+
+  # Assigning consecutive blocks of the permuted presentations to each
+  # position lets every shuffle sum the counts with a single `reduceat`.
+  boundaries = np.concatenate([[0], np.cumsum(n[occupied])[:-1]])
+  rng = np.random.default_rng(random_state)
+  exceed = np.zeros(counts.shape[1])
+  for _ in range(n_shuffles):
+    shuffled = np.add.reduceat(counts[rng.permutation(len(position))], boundaries, axis=0)
+    exceed += _chi_square_statistic(shuffled, n[occupied]) >= statistic
+  return (exceed + 1) / (n_shuffles + 1)
+
+def _gaussian_2d(params: np.ndarray, xy: tuple[np.ndarray, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+  "Evaluate `amplitude * exp(-(dx²/2sx² + dy²/2sy²)) + offset` and its Jacobian."
+  x, y = xy
+  amplitude, x0, y0, sx, sy, offset = (params[:, i:i + 1] for i in range(6))
+  dx, dy = x - x0, y - y0
+  g = np.exp(-(dx ** 2 / (2 * sx ** 2) + dy ** 2 / (2 * sy ** 2)))
+  ag = amplitude * g
+  jac = np.stack([
+    g,
+    ag * dx / sx ** 2,
+    ag * dy / sy ** 2,
+    ag * dx ** 2 / sx ** 3,
+    ag * dy ** 2 / sy ** 3,
+    np.ones_like(g),
+  ], axis=-1)
+  return ag + offset, jac
+
+def fit_receptive_fields(rfs: ReceptiveFields, **kwargs) -> pd.DataFrame:
+  """Return the 2-D Gaussian fit of the receptive field of each unit.
+
+  All units are fitted together with `batched_least_squares`, to which
+  `kwargs` are passed.  The table is indexed by unit_id, with columns
+  amplitude, center_x, center_y, sigma_x, sigma_y, offset, r2 and
+  converged.
+
+  """
+  x, y = np.meshgrid(rfs.x_positions, rfs.y_positions)
+  x, y = x.ravel(), y.ravel()
+  data = rfs.maps.reshape(len(rfs.maps), -1)
+
+  spacing = min(np.min(np.diff(rfs.x_positions), initial=np.inf),
+                np.min(np.diff(rfs.y_positions), initial=np.inf))
+  if not np.isfinite(spacing):
+    spacing = 1.0
+  offset = np.nanmin(data, axis=1)
+  peak = np.nanargmax(np.where(np.isnan(data), -np.inf, data), axis=1)
+  params0 = np.stack([
+    np.nanmax(data, axis=1) - offset,
+    x[peak],
+    y[peak],
+    np.full(len(data), spacing),
+    np.full(len(data), spacing),
+    offset,
+  ], axis=1)
+
+  lower = np.array([0.0, x.min() - spacing, y.min() - spacing, spacing / 4, spacing / 4, -np.inf])
+  upper = np.array([np.inf, x.max() + spacing, y.max() + spacing, np.ptp(x) + spacing, np.ptp(y) + spacing, np.inf])
+  fit = batched_least_squares(_gaussian_2d, (x, y), data, params0,
+                              project=lambda p: np.clip(p, lower, upper), **kwargs)
+
+  df = pd.DataFrame(fit.params, index=rfs.unit_ids,
+                    columns=['amplitude', 'center_x', 'center_y', 'sigma_x', 'sigma_y', 'offset'])
+  df['r2'] = fit.r2
+  df['converged'] = fit.converged
+  return df
+
+def get_receptive_fields(window: Optional[tuple[float, float]] = None,
+                         session = None,
+                         **kwargs) -> ReceptiveFields:
+  """Return the receptive fields of the matching units over the gabor grid.
+
+  See `get_presentationwise_spike_counts` for `window`.  All filters
+  which `get_units` and `get_stimulus_presentations` accept are
+  meaningful.
+
+  """
+  kwargs['stimulus_name'] = 'gabors'
+  return compute_receptive_fields(*get_presentationwise_spike_counts(window, session=session, **kwargs))
+
+def get_receptive_field_table(window: Optional[tuple[float, float]] = None,
+                              method: Literal['chi2', 'shuffle'] = 'chi2',
+                              n_shuffles: int = 1000,
+                              unit_columns: None|set[str] = {'ecephys_structure_acronym'},
+                              session = None,
+                              **kwargs) -> pd.DataFrame:
+  """Return a table of the receptive field of each matching unit.
+
+  The table is indexed by unit_id, with the p-value of the RF (see
+  `receptive_field_p_values`), the grid position of its peak (peak_x,
+  peak_y), its Gaussian fit (see `fit_receptive_fields`), and the
+  `unit_columns` of the units (all of them if None).
+
+  See `get_presentationwise_spike_counts` for `window`.  All filters
+  which `get_units` and `get_stimulus_presentations` accept are
+  meaningful.
+
+  """
+  from dataset import get_units
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  kwargs['stimulus_name'] = 'gabors'
+  kwargs['session'] = session
+  kwargs['__total__'] = False
+  presentations, unit_ids, counts = get_presentationwise_spike_counts(window, **kwargs)
+  rfs = compute_receptive_fields(presentations, unit_ids, counts)
+
+  flat = rfs.maps.reshape(len(unit_ids), -1)
+  peak = np.nanargmax(np.where(np.isnan(flat), -np.inf, flat), axis=1)
+  df = pd.DataFrame({
+    'p_value': receptive_field_p_values(presentations, counts, method=method, n_shuffles=n_shuffles),
+    'peak_x': rfs.x_positions[peak % len(rfs.x_positions)],
+    'peak_y': rfs.y_positions[peak // len(rfs.x_positions)],
+  }, index=unit_ids).join(fit_receptive_fields(rfs))
+
+  units = get_units(**kwargs)
+  if unit_columns is not None:
+    units = units[list(unit_columns)]
+  return df.join(units)
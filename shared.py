@@ -0,0 +1,297 @@
+from typing import *
+import concurrent.futures
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+"""
+
+This module publishes the numeric tables and spike trains of a session
+once into shared memory, so that worker processes can use them
+without reopening the NWB file or receiving pickled copies.
+
+`SharedSession` copies the tables into a single shared memory block
+and describes its layout in a small picklable `descriptor`.  Workers
+`attach` the descriptor and get pandas/NumPy views of the block, so
+the memory used by the session does not grow with the number of
+workers.  Non-numeric columns are stored as integer codes in the
+block, with their (few) distinct values in the descriptor.
+
+Example:
+
+  ```
+    def tuning(view, unit_ids):
+      units = view.tables['units'].loc[unit_ids]
+      ...
+
+    with publish_session() as shared:
+      results = map_units(tuning, shared, n_workers=8)
+  ```
+
+"""
+
+_ALIGNMENT: Final[int] = 64
+
+def _attach_shm(name: str) -> shared_memory.SharedMemory:
+  "Attach the shared memory block `name` without taking ownership of it."
+  try:
+    return shared_memory.SharedMemory(name=name, track=False)
+  except TypeError:
+    # Before Python 3.13, attaching always registers the block with the
+    # resource tracker.  Worker processes share the tracker of the
+    # process which created the block, so this is harmless there.
+    return shared_memory.SharedMemory(name=name)
+
+def _encode_column(values: pd.Series|pd.Index) -> tuple[np.ndarray, Optional[list], Any]:
+  """Return the array to share for `values`, its distinct values and its dtype.
+
+  Plain NumPy numeric, boolean and datetime columns are shared as is;
+  other columns are shared as codes into the returned distinct values.
+
+  """
+  if isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufcmM':
+    return np.ascontiguousarray(values.to_numpy()), None, values.dtype
+  try:
+    codes, categories = pd.factorize(values, use_na_sentinel=True)
+  except TypeError:
+    raise TypeError(f"Column {values.name!r} holds unhashable values and cannot be shared")
+  dtype = np.int8 if len(categories) < 2**7 else np.int16 if len(categories) < 2**15 else np.int32
+  return codes.astype(dtype), list(categories), values.dtype
+
+class SharedSession():
+  """Tables and spike trains published in shared memory.
+
+  `tables` maps names to dataframes, and `spike_times` maps unit ids to
+  their sorted spike times.  The data is copied once into a shared
+  memory block, which lives until `close` is called (or the `with`
+  block is left).  `descriptor` is what worker processes need to
+  `attach` it; they must be started by the process publishing it.
+
+  The index levels and columns of each table must have distinct names,
+  e.g. not `df.set_index('unit_id', drop=False)`.
+
+  """
+  def __init__(self,
+               tables: Mapping[str, pd.DataFrame] = {},
+               spike_times: Optional[Mapping[int, np.ndarray]] = None):
+    arrays: list[np.ndarray] = []
+    def add(array: np.ndarray) -> int:
+      arrays.append(array)
+      return len(arrays) - 1
+
+    table_layouts = {}
+    for name, df in tables.items():
+      index_names = [n if n is not None else f'level_{i}' for i, n in enumerate(df.index.names)]
+      names = index_names + list(df.columns)
+      duplicates = sorted({str(n) for n in names if names.count(n) > 1})
+      if duplicates:
+        raise ValueError(f"Table {name!r} has several index levels or columns named {', '.join(duplicates)}")
+      columns = []
+      for column, values in list(zip(index_names, (df.index.get_level_values(i) for i in range(df.index.nlevels)))) \
+                            + list(df.items()):
+        array, categories, dtype = _encode_column(values)
+        columns.append((column, add(array), categories, dtype))
+      table_layouts[name] = {
+        'index': index_names,
+        'index_is_unnamed': list(df.index.names) == [None],
+        'columns': columns,
+        'column_order': list(df.columns),
+      }
+
+    spike_layout = None
+    if spike_times is not None:
+      unit_ids = np.asarray(list(spike_times.keys()))
+      lengths = np.array([len(spike_times[u]) for u in unit_ids], dtype=np.int64)
+      offsets = np.concatenate([[0], np.cumsum(lengths)])
+      times = np.concatenate([np.asarray(spike_times[u], dtype=np.float64) for u in unit_ids]) \
+        if len(unit_ids) else np.empty(0)
+      spike_layout = {'unit_ids': add(unit_ids), 'offsets': add(offsets), 'times': add(times)}
+
+    buffers, size = [], 0
+    for array in arrays:
+      size = -(-size // _ALIGNMENT) * _ALIGNMENT
+      buffers.append((size, array.dtype.str, array.shape))
+      size += array.nbytes
+
+    self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for (offset, _, _), array in zip(buffers, arrays):
+      np.ndarray(array.shape, array.dtype, buffer=self.shm.buf, offset=offset)[...] = array
+
+    self.descriptor: dict[str, Any] = {
+      'name': self.shm.name,
+      'buffers': buffers,
+      'tables': table_layouts,
+      'spike_times': spike_layout,
+    }
+
+  def close(self):
+    "Release and destroy the shared memory block."
+    if self.shm is not None:
+      self.shm.close()
+      self.shm.unlink()
+      self.shm = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class SharedSpikeTimes(Mapping):
+  """Read-only mapping of unit ids to views of their spike times."""
+  def __init__(self, unit_ids: np.ndarray, offsets: np.ndarray, times: np.ndarray):
+    self.unit_ids = unit_ids
+    self._offsets = offsets
+    self._times = times
+    self._rows = pd.Index(unit_ids)
+
+  def __getitem__(self, unit_id):
+    row = self._rows.get_loc(unit_id)
+    return self._times[self._offsets[row]:self._offsets[row + 1]]
+
+  def __iter__(self):
+    return iter(self.unit_ids)
+
+  def __len__(self):
+    return len(self.unit_ids)
+
+class SharedView():
+  """Views of a `SharedSession` attached in another process.
+
+  `tables` maps names to dataframes and `spike_times` unit ids to spike
+  times, as given to `SharedSession`.  The numeric data are read-only
+  views of the shared memory block.
+
+  If `categorical` is True, non-numeric columns are pandas
+  categoricals over the shared codes; otherwise they are decoded into
+  ordinary (per-process) object columns, which behave exactly like the
+  original ones, e.g. with `filter_df`.
+
+  """
+  def __init__(self, descriptor: Mapping[str, Any], categorical: bool = False):
+    self.shm = _attach_shm(descriptor['name'])
+    arrays = []
+    for offset, dtype, shape in descriptor['buffers']:
+      array = np.ndarray(shape, np.dtype(dtype), buffer=self.shm.buf, offset=offset)
+      array.flags.writeable = False
+      arrays.append(array)
+
+    self.tables: dict[str, pd.DataFrame] = {}
+    for name, layout in descriptor['tables'].items():
+      def decode(i, categories, dtype, index=None):
+        if categories is None:
+          return arrays[i]
+        if categorical:
+          return pd.Categorical.from_codes(arrays[i], categories=pd.Index(categories, dtype=object))
+        decoded = np.empty(len(categories) + 1, dtype=object)
+        decoded[:-1] = categories
+        decoded[-1] = np.nan
+        return pd.Series(decoded[arrays[i]], index=index, dtype=dtype)
+
+      # Build the index and frame directly, as `set_index` would copy.
+      columns = {column: spec for column, *spec in layout['columns']}
+      levels = [decode(*columns[level]) for level in layout['index']]
+      if len(levels) == 1:
+        index = pd.Index(levels[0], name=None if layout['index_is_unnamed'] else layout['index'][0], copy=False)
+      else:
+        index = pd.MultiIndex.from_arrays(levels, names=layout['index'])
+      self.tables[name] = pd.DataFrame({column: decode(*columns[column], index=index)
+                                        for column in layout['column_order']},
+                                       index=index, copy=False)
+
+    layout = descriptor['spike_times']
+    self.spike_times: Optional[SharedSpikeTimes] = None
+    if layout is not None:
+      self.spike_times = SharedSpikeTimes(arrays[layout['unit_ids']],
+                                          arrays[layout['offsets']],
+                                          arrays[layout['times']])
+
+  def close(self):
+    "Detach from the shared memory block; views must not be used afterwards."
+    self.tables, self.spike_times = {}, None
+    try:
+      self.shm.close()
+    except BufferError:
+      # Views are still referenced elsewhere; the mapping is released
+      # when they are garbage collected.
+      pass
+
+def attach(descriptor: Mapping[str, Any], categorical: bool = False) -> SharedView:
+  "Return views of the `SharedSession` described by `descriptor`."
+  return SharedView(descriptor, categorical=categorical)
+
+def publish_session(tables: Iterable[str] = ('units', 'stimulus_presentations'),
+                    spike_times: bool = True,
+                    unit_ids: Optional[Collection[int]] = None,
+                    session = None,
+                    **extra_tables: pd.DataFrame) -> SharedSession:
+  """Publish the `tables` attributes of `session` and its spike times in shared memory.
+
+  `unit_ids` narrows the units (and their spike times) published.
+  Additional dataframes, e.g. a filtered `get_spike_info` table, can be
+  published by name as `extra_tables`.  By default `session` is
+  `dataset.CURRENT_SESSION`.
+
+  """
+  if session is None:
+    from dataset import CURRENT_SESSION as session
+  published = {name: getattr(session, name) for name in tables}
+  if unit_ids is not None and 'units' in published:
+    published['units'] = published['units'].loc[list(unit_ids)]
+  published.update(extra_tables)
+
+  spikes = None
+  if spike_times:
+    spikes = session.spike_times
+    if unit_ids is not None:
+      spikes = {unit_id: spikes[unit_id] for unit_id in unit_ids}
+  return SharedSession(published, spikes)
+
+_WORKER_VIEW: Optional[SharedView] = None
+
+def _init_worker(descriptor: Mapping[str, Any], categorical: bool):
+  global _WORKER_VIEW
+  _WORKER_VIEW = attach(descriptor, categorical=categorical)
+
+def _run_worker(func: Callable, unit_ids: np.ndarray, kwargs: Mapping[str, Any]):
+  return func(_WORKER_VIEW, unit_ids, **kwargs)
+
+def map_units(func: Callable,
+              shared: SharedSession|Mapping[str, Any],
+              unit_ids: Optional[Collection[int]] = None,
+              n_workers: Optional[int] = None,
+              n_chunks: Optional[int] = None,
+              categorical: bool = False,
+              **kwargs) -> list:
+  """Call `func(view, unit_ids_chunk, **kwargs)` on chunks of units in worker processes.
+
+  Each worker attaches `shared` (a `SharedSession` or its descriptor)
+  once, and is then sent only chunks of unit ids.  `unit_ids` defaults
+  to the published spike trains' units, and is split into `n_chunks`
+  chunks (by default four per worker).  Returns the results of `func`
+  in the order of the chunks.
+
+  `func` must be picklable, i.e. defined at the top level of a module.
+
+  """
+  descriptor = shared.descriptor if isinstance(shared, SharedSession) else shared
+  if unit_ids is None:
+    if descriptor['spike_times'] is None:
+      raise ValueError("`unit_ids` is required when no spike times are published")
+    shm = _attach_shm(descriptor['name'])
+    offset, dtype, shape = descriptor['buffers'][descriptor['spike_times']['unit_ids']]
+    unit_ids = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf, offset=offset).copy()
+    shm.close()
+
+  if n_workers is None:
+    n_workers = os.cpu_count() or 1
+  if n_chunks is None:
+    n_chunks = 4 * n_workers
+  chunks = [chunk for chunk in np.array_split(np.asarray(unit_ids), n_chunks) if len(chunk)]
+  with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                              initializer=_init_worker,
+                                              initargs=(descriptor, categorical)) as executor:
+    futures = [executor.submit(_run_worker, func, chunk, kwargs) for chunk in chunks]
+    return [future.result() for future in futures]
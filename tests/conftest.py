@@ -0,0 +1,45 @@
+import pathlib
+import sys
+import types
+
+import pytest
+
+# The modules live at the root of the project rather than in a package.
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from constraints import *
+
+@pytest.fixture
+def fake_dataset(monkeypatch):
+  """Replace the `dataset` module by one filtering the tables of any session object.
+
+  The real module downloads `CURRENT_SESSION` from the Allen warehouse
+  when imported; this one has no current session.
+
+  """
+  module = types.ModuleType('dataset')
+
+  def get_units(ecephys_structure_acronym=None, unit_ids=None, session=None, **kwargs):
+    if ecephys_structure_acronym is not None:
+      kwargs['ecephys_structure_acronym'] = ecephys_structure_acronym
+    units = session.units if unit_ids is None else session.units.loc[unit_ids]
+    return filter_df(units, FIELD(**kwargs))
+
+  def get_stimulus_presentations(stimulus_name=None, stimulus_presentation_ids=None,
+                                 stimulus_condition_id=None, session=None, **kwargs):
+    if stimulus_name is not None:
+      kwargs['stimulus_name'] = stimulus_name
+    if stimulus_condition_id is not None:
+      kwargs['stimulus_condition_id'] = stimulus_condition_id
+    presentations = session.stimulus_presentations
+    if stimulus_presentation_ids is not None:
+      presentations = presentations.loc[stimulus_presentation_ids]
+    return filter_df(presentations, FIELD(**kwargs))
+
+  module.get_units = get_units
+  module.get_unit_ids = lambda *args, **kwargs: get_units(*args, **kwargs).index
+  module.get_stimulus_presentations = get_stimulus_presentations
+  module.get_stimulus_presentation_ids = lambda *args, **kwargs: get_stimulus_presentations(*args, **kwargs).index
+  module.CURRENT_SESSION = None
+  monkeypatch.setitem(sys.modules, 'dataset', module)
+  return module
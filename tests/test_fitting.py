@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from fitting import batched_least_squares
+from tuning import fit_tuning_curves
+
+def _line(params, x):
+  pred = params[:, :1] + params[:, 1:2] * x
+  jac = np.stack([np.ones_like(pred), np.broadcast_to(x, pred.shape)], axis=-1)
+  return pred, jac
+
+def _line_wrong_jacobian(params, x):
+  pred, jac = _line(params, x)
+  return pred, -jac
+
+def test_exact_fit_converged():
+  x = np.linspace(0, 1, 5)
+  y = np.array([1 + 2 * x, -3 * x])
+  fit = batched_least_squares(_line, x, y, np.zeros((2, 2)))
+  np.testing.assert_allclose(fit.params, [[1, 2], [0, -3]], atol=1e-4)
+  assert fit.converged.all()
+
+def test_stuck_not_converged():
+  x = np.linspace(0, 1, 5)
+  fit = batched_least_squares(_line_wrong_jacobian, x, np.array([1 + 2 * x]), np.zeros((1, 2)))
+  assert not fit.converged.any()
+  assert fit.n_iter < 100
+
+def test_max_iter_not_converged():
+  x = np.linspace(0, 1, 5)
+  fit = batched_least_squares(_line, x, np.array([1 + 2 * x + np.sin(7 * x)]), np.zeros((1, 2)), max_iter=0)
+  assert not fit.converged.any() and fit.n_iter == 0
+
+def test_noisy_tuning_curves_converge():
+  rng = np.random.default_rng(0)
+  n = 500
+  orientations = np.arange(0, 180, 30.0)
+  phi = np.deg2rad(orientations) * 2
+  mu = rng.uniform(0, 2 * np.pi, n)
+  kappa, amplitude, baseline = rng.uniform(0.5, 5, n), rng.uniform(2, 10, n), rng.uniform(0, 5, n)
+  curves = baseline[:, None] + amplitude[:, None] * np.exp(kappa[:, None] * (np.cos(phi - mu[:, None]) - 1))
+  curves += rng.normal(0, 0.3, curves.shape)
+
+  fits = fit_tuning_curves(pd.DataFrame(curves, columns=orientations))
+  assert fits['converged'].mean() > 0.97
+  error = (fits['preferred_orientation'] - np.rad2deg(mu) / 2 + 90) % 180 - 90
+  assert np.median(np.abs(error)) < 3.0
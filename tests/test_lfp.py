@@ -0,0 +1,85 @@
+import pathlib
+import subprocess
+import sys
+
+import types
+
+import h5py
+import numpy as np
+import pytest
+
+from lfp import _download_lfp_nwb, cache_lfp, compute_lfp_band_power, iter_lfp_chunks
+
+FS = 1250.0
+N_SAMPLES = 25000
+TABLE_IDS = np.array([100, 101, 102, 103, 104, 105])
+ELECTRODES = np.array([5, 1, 3, 2])
+CONVERSION = 0.5
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+@pytest.fixture
+def nwb_path(tmp_path):
+  rng = np.random.default_rng(0)
+  t = np.arange(N_SAMPLES) / FS
+  signal = (np.sin(2 * np.pi * 6 * t)[:, None] * np.arange(1, len(ELECTRODES) + 1)
+            + 0.5 * np.sin(2 * np.pi * 40 * t)[:, None]
+            + 0.2 * rng.standard_normal((N_SAMPLES, len(ELECTRODES))))
+  path = tmp_path / 'probe_lfp.nwb'
+  with h5py.File(path, 'w') as f:
+    series = f.create_group('acquisition/probe_1_lfp/probe_1_lfp_data')
+    data = series.create_dataset('data', data=np.round(signal * 1000).astype(np.int16), chunks=(1000, 2))
+    data.attrs['conversion'] = CONVERSION
+    series.create_dataset('timestamps', data=10.0 + t)
+    series.create_dataset('electrodes', data=ELECTRODES)
+    f.create_dataset('general/extracellular_ephys/electrodes/id', data=TABLE_IDS)
+  return path
+
+def test_no_dataset_import():
+  script = "import sys, lfp; assert 'dataset' not in sys.modules"
+  subprocess.run([sys.executable, '-c', script], cwd=ROOT, check=True)
+
+def test_download_without_private_api():
+  with pytest.raises(RuntimeError, match='nwb_path'):
+    _download_lfp_nwb(1, types.SimpleNamespace(api=object()))
+  with pytest.raises(RuntimeError, match='nwb_path'):
+    _download_lfp_nwb(1, types.SimpleNamespace(api=types.SimpleNamespace(_probe_lfp_paths={})))
+
+def test_cache_round_trip(nwb_path, tmp_path):
+  lfp = cache_lfp(1, nwb_path=nwb_path, cache_dir=tmp_path / 'cache', chunk_size=999)
+  with h5py.File(nwb_path, 'r') as f:
+    series = f['acquisition/probe_1_lfp/probe_1_lfp_data']
+    expected = series['data'][:].astype(np.float32) * np.float32(CONVERSION)
+    timestamps = series['timestamps'][:]
+  np.testing.assert_array_equal(lfp.data, expected)
+  np.testing.assert_array_equal(lfp.timestamps, timestamps)
+  np.testing.assert_array_equal(lfp.channel_ids, TABLE_IDS[ELECTRODES])
+  assert lfp.sampling_rate == pytest.approx(FS)
+
+  # The cache is reused as is.
+  again = cache_lfp(1, nwb_path=tmp_path / 'missing.nwb', cache_dir=tmp_path / 'cache')
+  np.testing.assert_array_equal(again.data, expected)
+
+def test_chunks_cover_range(nwb_path):
+  starts = [lo for lo, _ in iter_lfp_chunks(nwb_path, chunk_size=4000, start=1000, stop=9500)]
+  assert starts == [1000, 5000, 9000]
+
+@pytest.mark.parametrize('method, rtol', [('welch', 1e-6), ('hilbert', 2e-2)])
+def test_band_power_chunk_invariant(nwb_path, tmp_path, method, rtol):
+  lfp = cache_lfp(1, nwb_path=nwb_path, cache_dir=tmp_path / 'cache')
+  rng = np.random.default_rng(1)
+  # Including onsets whose window falls outside of the recording.
+  onsets = np.concatenate([10.0 + rng.uniform(1, 18, 40), [5.0, 29.9]])
+  bands = {'theta': (4.0, 8.0), 'gamma': (30.0, 50.0)}
+
+  whole = compute_lfp_band_power(lfp, onsets, bands=bands, method=method, chunk_size=N_SAMPLES)
+  small = compute_lfp_band_power(lfp, onsets, bands=bands, method=method, chunk_size=400)
+  shuffle = rng.permutation(len(onsets))
+  shuffled = compute_lfp_band_power(lfp, onsets[shuffle], bands=bands, method=method, chunk_size=400)
+
+  assert whole.shape == (len(onsets), len(ELECTRODES), len(bands))
+  assert np.isnan(whole[-2:]).all() and not np.isnan(whole[:-2]).any()
+  np.testing.assert_allclose(small, whole, rtol=rtol)
+  np.testing.assert_allclose(shuffled, whole[shuffle], rtol=rtol)
+  # The theta amplitude grows with the channel.
+  assert (np.diff(whole[:-2, :, 0].mean(axis=0)) > 0).all()
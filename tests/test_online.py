@@ -0,0 +1,138 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from online import ConditionwiseSpikeAccumulator, replay_conditionwise_spike_statistics
+
+UNIT_IDS = np.array([7, 3, 11])
+
+@pytest.fixture
+def recording():
+  "Return non-overlapping presentations and the sorted spikes of `UNIT_IDS` and of an ignored unit."
+  rng = np.random.default_rng(0)
+  n = 80
+  durations = rng.uniform(0.25, 0.5, n)
+  gaps = rng.uniform(0.0, 0.2, n)
+  starts = np.cumsum(gaps + np.concatenate([[0], durations[:-1]])) + 1.0
+  presentations = pd.DataFrame({
+    'start_time': starts,
+    'stop_time': starts + durations,
+    'stimulus_condition_id': rng.choice([4, 5, 6], n),
+    'stimulus_name': 'static_gratings',
+  }, index=pd.Index(rng.permutation(np.arange(1000, 1000 + n)), name='stimulus_presentation_id'))
+
+  end = presentations['stop_time'].max() + 1.0
+  times, units = [], []
+  for rate, unit_id in zip([5.0, 20.0, 40.0, 10.0], list(UNIT_IDS) + [99]):
+    unit_times = np.sort(rng.uniform(0, end, rng.poisson(rate * end)))
+    times.append(unit_times)
+    units.append(np.full(len(unit_times), unit_id))
+  times, units = np.concatenate(times), np.concatenate(units)
+  order = np.argsort(times, kind='stable')
+  return presentations, times[order], units[order]
+
+def brute_force(presentations, times, units, use_rates):
+  "Return the expected snapshot, computed presentation by presentation."
+  rows = []
+  for unit_id in UNIT_IDS:
+    unit_times = times[units == unit_id]
+    counts = np.array([np.sum((start <= unit_times) & (unit_times < stop))
+                       for start, stop in zip(presentations['start_time'], presentations['stop_time'])])
+    values = counts / presentations['duration'].to_numpy() if use_rates else counts.astype(float)
+    for condition_id in np.unique(presentations['stimulus_condition_id']):
+      mask = (presentations['stimulus_condition_id'] == condition_id).to_numpy()
+      std = np.std(values[mask], ddof=1) if mask.sum() > 1 else np.nan
+      rows.append({
+        'unit_id': unit_id,
+        'stimulus_condition_id': condition_id,
+        'spike_count': counts[mask].sum(),
+        'stimulus_presentation_count': mask.sum(),
+        'spike_mean': values[mask].mean(),
+        'spike_std': std,
+        'spike_sem': std / np.sqrt(mask.sum()),
+      })
+  return pd.DataFrame(rows).set_index(['unit_id', 'stimulus_condition_id'])
+
+def check(snapshot, presentations, times, units, use_rates):
+  presentations = presentations.assign(duration=presentations['stop_time'] - presentations['start_time'])
+  expected = brute_force(presentations, times, units, use_rates)
+  pd.testing.assert_frame_equal(snapshot.sort_index(), expected.sort_index(), check_dtype=False)
+
+def add_presentations(acc, presentations):
+  acc.add_presentations(presentations.index, presentations['start_time'],
+                        presentations['stop_time'], presentations['stimulus_condition_id'])
+
+@pytest.mark.parametrize('use_rates', [False, True])
+def test_spikes_in_batches(recording, use_rates):
+  presentations, times, units = recording
+  acc = ConditionwiseSpikeAccumulator(UNIT_IDS, use_rates=use_rates)
+  add_presentations(acc, presentations)
+  for lo in range(0, len(times), 17):
+    acc.add_spikes(times[lo:lo + 17], units[lo:lo + 17])
+  acc.flush()
+  check(acc.snapshot(), presentations, times, units, use_rates)
+
+@pytest.mark.parametrize('use_rates', [False, True])
+def test_presentations_added_incrementally(recording, use_rates):
+  presentations, times, units = recording
+  acc = ConditionwiseSpikeAccumulator(UNIT_IDS, use_rates=use_rates)
+  edges = np.arange(0, times.max() + 2.0, 1.5)
+  for lo, hi in zip(edges[:-1], edges[1:]):
+    add_presentations(acc, presentations[(lo <= presentations['start_time']) & (presentations['start_time'] < hi)])
+    in_chunk = (lo <= times) & (times < hi)
+    acc.add_spikes(times[in_chunk], units[in_chunk], advance=False)
+    acc.advance(hi)
+  acc.flush()
+  check(acc.snapshot(), presentations, times, units, use_rates)
+
+@pytest.mark.parametrize('use_rates', [False, True])
+def test_merge_halves_sharing_open_presentation(recording, use_rates):
+  presentations, times, units = recording
+  by_start = presentations.sort_values('start_time')
+  shared = by_start.iloc[len(by_start) // 2]
+  split = (shared['start_time'] + shared['stop_time']) / 2
+
+  # The first half closes what stops before `split`, keeping the shared
+  # presentation open; the second half closes nothing before merging.
+  first = ConditionwiseSpikeAccumulator(UNIT_IDS, use_rates=use_rates)
+  add_presentations(first, by_start[by_start['start_time'] < split])
+  first.add_spikes(times[times < split], units[times < split], advance=False)
+  first.advance(split)
+  second = ConditionwiseSpikeAccumulator(UNIT_IDS, use_rates=use_rates)
+  add_presentations(second, by_start[by_start['stop_time'] > split])
+  second.add_spikes(times[times >= split], units[times >= split], advance=False)
+
+  merged = first.merge(second)
+  merged.flush()
+  check(merged.snapshot(), presentations, times, units, use_rates)
+
+@pytest.mark.parametrize('use_rates', [False, True])
+def test_merge_closed_halves(recording, use_rates):
+  presentations, times, units = recording
+  by_start = presentations.sort_values('start_time')
+  split = by_start['stop_time'].iloc[len(by_start) // 3]
+
+  halves = []
+  for keep, in_half in [(by_start['start_time'] < split, times < split),
+                        (by_start['start_time'] >= split, times >= split)]:
+    acc = ConditionwiseSpikeAccumulator(UNIT_IDS, use_rates=use_rates)
+    add_presentations(acc, by_start[keep])
+    acc.add_spikes(times[in_half], units[in_half])
+    acc.flush()
+    halves.append(acc)
+  check(halves[1].merge(halves[0]).snapshot(), presentations, times, units, use_rates)
+
+@pytest.mark.parametrize('use_rates', [False, True])
+def test_replay(recording, fake_dataset, use_rates):
+  presentations, times, units = recording
+  session = types.SimpleNamespace(
+    units=pd.DataFrame({'ecephys_structure_acronym': ['VISp', 'VISl', 'VISp', 'LGd']},
+                       index=pd.Index(list(UNIT_IDS) + [99], name='unit_id')),
+    stimulus_presentations=presentations,
+    spike_times={unit_id: times[units == unit_id] for unit_id in list(UNIT_IDS) + [99]},
+  )
+  snapshot = replay_conditionwise_spike_statistics(use_rates, chunk_duration=2.5, session=session,
+                                                   ecephys_structure_acronym=['VISp', 'VISl'])
+  check(snapshot, presentations, times, units, use_rates)
@@ -0,0 +1,133 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from constraints import *
+from pipeline import Pipeline, Stage
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+KEYS_SCRIPT = """
+import json, sys
+import numpy as np
+from constraints import *
+from pipeline import Pipeline
+
+p = Pipeline(sys.argv[1])
+p.add('units', filter_df,
+      isi_violations=RANGE(None, 0.7),
+      ecephys_structure_acronym=['VISp', 'VISl'],
+      quality=ISIN({'good', 'noise', 'mua'}),
+      firing_rate=AND(NOT(EQ(0)), SATISFIES(np.isfinite)),
+      filters={'__total__': False, 'spikes': FIELD(unit_id=CONTAINS(RANGE(1, 3)))})
+p.add('count', len, deps=['units'])
+print(json.dumps(p.keys()))
+"""
+
+def _keys_in_subprocess(cache_dir):
+  out = subprocess.run([sys.executable, '-c', KEYS_SCRIPT, str(cache_dir)],
+                       cwd=ROOT, capture_output=True, text=True, check=True).stdout
+  return json.loads(out)
+
+def test_keys_match_across_processes(tmp_path):
+  first = _keys_in_subprocess(tmp_path)
+  second = _keys_in_subprocess(tmp_path)
+  assert first == second
+  assert set(first) == {'units', 'count'}
+
+def test_constraint_params_change_key():
+  keys = [Stage('units', filter_df, params={'isi_violations': RANGE(None, ub)}).fingerprint()
+          for ub in (0.5, 0.7, 0.7)]
+  assert keys[0] != keys[1] == keys[2]
+
+def test_unstable_params_rejected():
+  stage = Stage('units', filter_df, params={'anything': object()})
+  with pytest.raises(ValueError, match='units'):
+    stage.fingerprint()
+
+def test_container_constraints_reusable():
+  c = OR(RANGE(None, 1), EQ(5))
+  assert 5 in c and 5 in c
+  assert repr(c) == 'OR(RANGE(None, 1, lb_strict=False, ub_strict=True), EQ(5))'
+
+def _helper_a(x):
+  return x + 1
+
+def _helper_b(x):
+  return x + 2
+
+def _wrapper(x):
+  return _helper_a(x)
+
+def test_used_functions_change_key():
+  keys = [Stage('wrapped', _wrapper, uses=uses).fingerprint()
+          for uses in ([], [_helper_a], [_helper_b], [_helper_a])]
+  assert len(set(keys[:3])) == 3
+  assert keys[1] == keys[3]
+
+def _square(x):
+  return x * x
+
+def _add(*xs):
+  return sum(xs)
+
+def _toy_pipeline(cache_dir):
+  p = Pipeline(cache_dir)
+  p.add('a', _square, x=3)
+  p.add('b', _square, x=4)
+  p.add('sum', _add, deps=['a', 'b'])
+  return p
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_run_and_cache(tmp_path, processes):
+  p = _toy_pipeline(tmp_path)
+  assert p.run(processes=processes)['sum'] == 25
+  assert p.stale() == []
+  assert p.run(['sum'], force=['b'], processes=processes) == {'a': 9, 'b': 16, 'sum': 25}
+
+def test_unknown_stages_rejected(tmp_path):
+  p = _toy_pipeline(tmp_path)
+  with pytest.raises(ValueError, match="'sums'"):
+    p.run(['sums'])
+  with pytest.raises(ValueError, match="'bb'"):
+    p.run(force=['bb'])
+  with pytest.raises(ValueError, match="'c'"):
+    p.stale(['c'])
+
+def _above_one(x):
+  return x > 1
+
+def _above_five(x):
+  return x > 5
+
+def _key(**params):
+  return Stage('units', filter_df, params=params).fingerprint()
+
+def test_lambdas_rejected():
+  with pytest.raises(ValueError, match='lambda'):
+    _key(firing_rate=SATISFIES(lambda x: x > 1))
+
+def test_satisfies_keyed_by_source():
+  assert _key(firing_rate=SATISFIES(_above_one)) != _key(firing_rate=SATISFIES(_above_five))
+
+@pytest.mark.parametrize('make', [
+  lambda values: pd.Index(values, name='unit_id'),
+  lambda values: np.asarray(values),
+  lambda values: pd.Series(values),
+])
+def test_large_arrays_keyed_by_content(make):
+  values = np.arange(2000)
+  changed = values.copy()
+  changed[1000] = -1
+  assert _key(unit_ids=make(values)) != _key(unit_ids=make(changed))
+  assert _key(unit_ids=make(values)) == _key(unit_ids=make(values.copy()))
+  assert _key(units=ISIN(make(values))) != _key(units=ISIN(make(changed)))
+
+def test_nested_dict_order_ignored():
+  assert _key(filters={'a': 1, 'b': RANGE(0, 1)}) == _key(filters={'b': RANGE(0, 1), 'a': 1})
+  assert _key(filters={'a': 1, 'b': RANGE(0, 1)}) != _key(filters={'a': 1, 'b': RANGE(0, 2)})
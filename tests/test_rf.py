@@ -0,0 +1,81 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rf import (compute_receptive_fields, fit_receptive_fields, get_presentationwise_spike_counts,
+                receptive_field_p_values)
+
+GRID = np.arange(-40.0, 41.0, 10.0)
+N_TUNED, N_UNTUNED = 20, 400
+
+@pytest.fixture(scope='module')
+def gabors():
+  "Return 15 presentations at each point of a 9×9 grid, Poisson counts and the true RF centres."
+  rng = np.random.default_rng(0)
+  x, y = np.meshgrid(GRID, GRID)
+  positions = np.repeat(np.column_stack([x.ravel(), y.ravel()]), 15, axis=0)
+  positions = positions[rng.permutation(len(positions))]
+  presentations = pd.DataFrame(positions, columns=['x_position', 'y_position'],
+                               index=pd.Index(np.arange(len(positions)), name='stimulus_presentation_id'))
+
+  centers = rng.uniform(-25, 25, (N_TUNED, 2))
+  d2 = ((positions[:, None, :] - centers[None]) ** 2).sum(axis=-1)
+  rates = np.concatenate([1.0 + 6.0 * np.exp(-d2 / (2 * 12.0 ** 2)),
+                          np.full((len(positions), N_UNTUNED), 3.0)], axis=1)
+  unit_ids = pd.Index(np.arange(N_TUNED + N_UNTUNED) + 100, name='unit_id')
+  return presentations, unit_ids, rng.poisson(rates), centers
+
+def test_maps(gabors):
+  presentations, unit_ids, counts, _ = gabors
+  rfs = compute_receptive_fields(presentations, unit_ids, counts)
+  assert rfs.maps.shape == (len(unit_ids), len(GRID), len(GRID))
+  assert (rfs.presentation_counts == 15).all()
+  at = (presentations['x_position'] == GRID[2]) & (presentations['y_position'] == GRID[5])
+  np.testing.assert_allclose(rfs.maps[:, 5, 2], counts[at.to_numpy()].mean(axis=0))
+
+def test_centre_recovery(gabors):
+  presentations, unit_ids, counts, centers = gabors
+  fits = fit_receptive_fields(compute_receptive_fields(presentations, unit_ids[:N_TUNED], counts[:, :N_TUNED]))
+  errors = np.hypot(fits['center_x'] - centers[:, 0], fits['center_y'] - centers[:, 1])
+  assert np.median(errors) < 2.0 and errors.max() < 5.0
+  assert (fits['r2'] > 0.8).all()
+
+@pytest.mark.parametrize('method', ['chi2', 'shuffle'])
+def test_p_values(gabors, method):
+  presentations, _, counts, _ = gabors
+  p = receptive_field_p_values(presentations, counts, method=method, n_shuffles=200, random_state=1)
+  assert (p[:N_TUNED] < 0.01).all()
+  assert 0.02 < np.mean(p[N_TUNED:] < 0.05) < 0.09
+
+def test_missing_grid_points(gabors):
+  presentations, unit_ids, counts, centers = gabors
+  missing = (((presentations['x_position'] == 0) & (presentations['y_position'] == 0))
+             | ((presentations['x_position'] == 40) & (presentations['y_position'] == -40))).to_numpy()
+  presentations, counts = presentations[~missing], counts[~missing]
+
+  rfs = compute_receptive_fields(presentations, unit_ids, counts)
+  assert rfs.presentation_counts[4, 4] == 0 and rfs.presentation_counts[0, 8] == 0
+  assert np.isnan(rfs.maps[:, 4, 4]).all() and np.isnan(rfs.maps[:, 0, 8]).all()
+  assert np.isfinite(np.delete(rfs.maps.reshape(len(unit_ids), -1), [4 * 9 + 4, 8], axis=1)).all()
+
+  p = receptive_field_p_values(presentations, counts)
+  assert np.isfinite(p).all() and (p[:N_TUNED] < 0.01).all()
+  fits = fit_receptive_fields(rfs._replace(maps=rfs.maps[:N_TUNED], unit_ids=unit_ids[:N_TUNED]))
+  errors = np.hypot(fits['center_x'] - centers[:, 0], fits['center_y'] - centers[:, 1])
+  assert np.isfinite(fits['r2']).all() and np.median(errors) < 2.0
+
+def test_window_past_presentation(fake_dataset):
+  presentations = pd.DataFrame({
+    'start_time': [1.0, 2.0], 'stop_time': [1.25, 2.25], 'stimulus_name': 'gabors',
+  }, index=pd.Index([10, 11], name='stimulus_presentation_id'))
+  session = types.SimpleNamespace(
+    units=pd.DataFrame({'ecephys_structure_acronym': ['VISp', 'VISp']}, index=pd.Index([1, 2], name='unit_id')),
+    stimulus_presentations=presentations,
+    spike_times={1: np.array([0.5, 1.0, 1.1, 1.3, 2.2, 2.4]), 2: np.array([2.25])},
+  )
+  _, unit_ids, counts = get_presentationwise_spike_counts(session=session, stimulus_name='gabors')
+  np.testing.assert_array_equal(counts, [[2, 0], [1, 0]])
+  _, _, counts = get_presentationwise_spike_counts((0.0, 0.5), session=session, stimulus_name='gabors')
+  np.testing.assert_array_equal(counts, [[3, 0], [2, 1]])
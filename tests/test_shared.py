@@ -0,0 +1,56 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shared import SharedSession, attach, map_units
+
+def test_round_trip():
+  units = pd.DataFrame({
+    'firing_rate': [1.5, 2.0, np.nan],
+    'ecephys_structure_acronym': ['VISp', 'VISl', None],
+  }, index=pd.Index([10, 11, 12], name='unit_id'))
+  spike_times = {10: np.array([0.1, 0.2]), 11: np.array([]), 12: np.array([0.5])}
+  with SharedSession({'units': units}, spike_times) as shared:
+    view = attach(shared.descriptor)
+    pd.testing.assert_frame_equal(view.tables['units'], units)
+    np.testing.assert_array_equal(view.spike_times[10], spike_times[10])
+    assert len(view.spike_times[11]) == 0
+    view.close()
+
+def test_index_column_collision_rejected():
+  units = pd.DataFrame({'unit_id': [10, 11], 'firing_rate': [1.0, 2.0]}).set_index('unit_id', drop=False)
+  with pytest.raises(ValueError, match='unit_id'):
+    SharedSession({'units': units})
+
+def _summarize(view, unit_ids, scale=1.0):
+  units = view.tables['units'].loc[unit_ids]
+  spike_times = [view.spike_times[unit_id] for unit_id in unit_ids]
+  # Views of the shared memory block are read-only; copies would not be.
+  shared = (not view.tables['units']['firing_rate'].to_numpy().flags.writeable
+            and not any(times.flags.writeable for times in spike_times))
+  return (os.getpid(), list(unit_ids), list(units['firing_rate'] * scale),
+          list(units['ecephys_structure_acronym']), [times.sum() for times in spike_times], shared)
+
+def test_map_units():
+  rng = np.random.default_rng(0)
+  unit_ids = np.arange(100, 130)
+  units = pd.DataFrame({
+    'firing_rate': rng.uniform(0, 10, len(unit_ids)),
+    'ecephys_structure_acronym': rng.choice(['VISp', 'VISl', 'LGd'], len(unit_ids)),
+  }, index=pd.Index(unit_ids, name='unit_id'))
+  spike_times = {unit_id: np.sort(rng.uniform(0, 100, rng.integers(0, 50))) for unit_id in unit_ids}
+
+  with SharedSession({'units': units}, spike_times) as shared:
+    results = map_units(_summarize, shared, n_workers=2, n_chunks=7, scale=2.0)
+
+  assert len(results) == 7
+  assert {pid for pid, *_ in results} - {os.getpid()}, "func must run in worker processes"
+  assert all(shared for *_, shared in results)
+  chunks = [chunk for _, chunk, *_ in results]
+  assert [unit_id for chunk in chunks for unit_id in chunk] == list(unit_ids)
+  for _, chunk, rates, regions, sums, _ in results:
+    np.testing.assert_allclose(rates, units.loc[chunk, 'firing_rate'] * 2.0)
+    assert regions == list(units.loc[chunk, 'ecephys_structure_acronym'])
+    np.testing.assert_allclose(sums, [spike_times[unit_id].sum() for unit_id in chunk])
@@ -0,0 +1,21 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tuning import fit_tuning_curves
+
+@pytest.mark.parametrize('model', ['von_mises', 'gaussian'])
+@pytest.mark.parametrize('period', [180.0, 360.0])
+def test_untuned_and_tuned(model, period):
+  orientations = np.arange(0, period, 30.0 if period == 180.0 else 45.0)
+  phi = np.deg2rad(orientations) * 360 / period
+  tuning_curves = pd.DataFrame({
+    'zero': np.zeros(len(orientations)),
+    'flat': np.full(len(orientations), 5.0),
+    'tuned': 2 + 8 * np.exp(3 * (np.cos(phi - 1.0) - 1)),
+  }, index=orientations).T
+
+  fits = fit_tuning_curves(tuning_curves, period=period, model=model)
+  assert fits.loc[['zero', 'flat'], ['preferred_orientation', 'bandwidth']].isna().all().all()
+  assert fits.loc['tuned', 'preferred_orientation'] == pytest.approx(np.rad2deg(1.0) * period / 360, abs=1.0)
+  assert 0 < fits.loc['tuned', 'bandwidth'] < period / 4